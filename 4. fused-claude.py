@@ -0,0 +1,87 @@
+import functions.prompts as prompts
+import functions.claude as claude
+import functions.backend as llm_backend
+import functions.fetch as fetch
+import functions.results as results
+import functions.stages as stages
+from functions.store import TripletStore
+import os
+import sys
+import dotenv
+
+dotenv.load_dotenv()
+
+import importlib
+importlib.reload(claude)
+importlib.reload(prompts)
+importlib.reload(fetch)
+importlib.reload(results)
+importlib.reload(stages)
+
+# Provider chosen by LLM_BACKEND (anthropic, openai, mock)
+backend = llm_backend.get_backend()
+
+def request_params(row, max_tokens=8192):
+    """Claude request with structured output for one abstract's findings and their triplets"""
+    return {
+        "model": "claude-opus-4-1-20250805",
+        "max_tokens": max_tokens,
+        "system": prompts.findings + "\n\n" + prompts.triplets + "\n\nFirst extract the findings of the abstract, then convert each finding in summaries into a triplet or a skip marker. Respond with valid JSON matching this schema, with exactly one entry in triplets per entry in summaries, in the same order:\n" + 
+                 '{"keywords": ["string"], "summaries": ["string"], "note": {"type": "string", "description": "string"}, "triplets": [{"cause": {"type": "string", "subtype": "string", "feature": "string"}, "relationship": "string", "effect": {"type": "string", "subtype": "string", "feature": "string"}, "net_outcome": "string"} OR {"skip": true}]}',
+        "messages": [{
+            "role": "user",
+            "content": row.title + "\n" + row.abstract
+        }]
+    }
+
+# The ref map goes where the findings stage writes it, for the graph stage
+stage = stages.AbstractStage("fused", backend, request_params, ref_path="data/findings/ref.csv")
+
+def main():
+    # Submit a request per abstract, skipping those with cached results
+    return stage.submit_abstracts()
+
+def get_results(batch_ids=None, downloaded=False):
+    """Get results from completed batches; `downloaded` when they are already in res.jsonl"""
+    return stage.get_results(process_results, batch_ids, downloaded)
+
+def process_results():
+    """Write the findings and triplet stage outputs from the fused res.jsonl"""
+    frames = results.ingest("data/fused/res.jsonl", "fused")
+    df, df_findings, df_triplets, df_keys = frames["res"], frames["findings"], frames["triplets"], frames["keys"]["key"].to_list()
+    
+    # Same artifacts as the separate findings and triplet stages
+    for path in ["data/findings", "data/triplets", "data/embeddings"]:
+        os.makedirs(path, exist_ok=True)
+    results.write(df, 'data/findings/res.csv')
+    results.write(df_findings, 'data/findings/findings.csv')
+    results.write(df_triplets, 'data/triplets/triplets.csv')
+    TripletStore().write(df_triplets)
+    fetch.save("\n".join(df_keys), "data/embeddings/keys.txt")
+    
+    print(f"Processed {len(df)} papers")
+    print(f"Extracted {len(df_findings)} findings and {len(df_triplets)} triplets")
+    print(f"Generated {len(df_keys)} unique keys")
+    
+    return df, df_findings, df_triplets, df_keys
+
+def retry(max_tokens=16384, repair=True):
+    """Resubmit errored, unparseable and incomplete results, with more output room and a repair instruction"""
+    return stage.retry_abstracts(max_tokens, repair)
+
+def get_retry_results(batch_ids=None, downloaded=False):
+    """Merge completed retry batches into res.jsonl and rewrite the stage outputs;
+    `downloaded` when they are already in res_retry.jsonl"""
+    return stage.get_retry_results(process_results, batch_ids, downloaded)
+
+if __name__ == "__main__":
+    # python "4. fused-claude.py" [submit|retry|retry-results]; PIPELINE_FUSED=1 python orchestrate.py runs all steps unattended
+    if "submit" in sys.argv[1:]:
+        batch = main()
+    elif "retry" in sys.argv[1:]:
+        batch = retry()
+    elif "retry-results" in sys.argv[1:]:
+        output = get_retry_results()
+    else:
+        # Get results (after batches complete)
+        output = get_results()
\ No newline at end of file
@@ -1,12 +1,16 @@
-from anthropic import Anthropic
-from pydantic import BaseModel
 import functions.prompts as prompts
 import functions.claude as claude
+import functions.backend as llm_backend
 import functions.fetch as fetch
 import functions.triplets as triplets
+import functions.results as results
+import functions.planner as planner
+import functions.stages as stages
+from functions.store import TripletStore
 import pandas as pd
 import json
 import os
+import sys
 import dotenv
 
 dotenv.load_dotenv()
@@ -16,134 +20,149 @@ importlib.reload(claude)
 importlib.reload(prompts)
 importlib.reload(fetch)
 importlib.reload(triplets)
+importlib.reload(results)
+importlib.reload(planner)
+importlib.reload(stages)
 
-client = Anthropic()
-
-class Subject(BaseModel):
-   type: str # human | ai | co ONLY
-   subtype: str # generative | student
-   feature: str # creativity | explaination | #trust
-   
-class Triplet(BaseModel):
-   cause: Subject
-   relationship: str
-   effect: Subject
-   net_outcome: str # positive | negative | neutral | undetermined
-   
-class SkipResult(BaseModel):
-   skip: bool
+# Provider chosen by LLM_BACKEND (anthropic, openai, mock)
+backend = llm_backend.get_backend()
+
+stage = stages.Stage("triplets", backend)
+
+def request_params(row, max_tokens=8192):
+    """Claude request with structured output for one finding"""
+    return {
+        "model": "claude-opus-4-1-20250805",
+        "max_tokens": max_tokens,
+        "system": prompts.triplets + "\n\nRespond with valid JSON matching this schema:\n" + 
+                 '{"cause": {"type": "string", "subtype": "string", "feature": "string"}, "relationship": "string", "effect": {"type": "string", "subtype": "string", "feature": "string"}, "net_outcome": "string"} OR {"skip": true}',
+        "messages": [{
+            "role": "user",
+            "content": row['finding']
+        }]
+    }
+
+# Findings per request: "1" sends each finding alone, "N" packs N consecutive
+# findings and "paper" packs the findings of each paper
+PACK = os.getenv("TRIPLET_PACK", "1")
+
+# Output cap of a packed request
+MAX_PACK_TOKENS = 32000
+
+def pack_findings(df, pack=PACK):
+    """Group the findings' (custom_id, finding) pairs into packs"""
+    items = [(f"{i}-{row['paper-id']}", row['finding']) for i, row in df.iterrows()]
+    if pack == "paper":
+        papers = {}
+        for item, paper_id in zip(items, df["paper-id"]):
+            papers.setdefault(paper_id, []).append(item)
+        return list(papers.values())
+    size = int(pack)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def pack_params(group, max_tokens=8192):
+    """Claude request with structured output for several findings, each tagged with its position"""
+    return {
+        "model": "claude-opus-4-1-20250805",
+        "max_tokens": min(max_tokens * len(group), MAX_PACK_TOKENS),
+        "system": prompts.triplets + "\n\nYou will receive several findings, each in a <finding> tag with an id. Convert each one separately and respond with valid JSON matching this schema, with exactly one result per finding in the same order:\n" + 
+                 '{"results": [{"id": "string", "cause": {"type": "string", "subtype": "string", "feature": "string"}, "relationship": "string", "effect": {"type": "string", "subtype": "string", "feature": "string"}, "net_outcome": "string"} OR {"id": "string", "skip": true}]}',
+        "messages": [{
+            "role": "user",
+            "content": "\n".join(f'<finding id="{k}">{finding}</finding>' for k, (custom_id, finding) in enumerate(group, 1))
+        }]
+    }
 
 def main():
     # Load findings
     df = pd.read_csv("./data/findings/findings.csv")
 
-    # Create batch requests
+    # Output cap learned from the per-finding output lengths of previous runs;
+    # cached packed results have no custom_id to split them by, so only res.jsonl counts then
+    previous_packs = results.load_packs()
+    history = stage.history(cached=not previous_packs)
+    max_tokens = planner.plan_max_tokens(history, packs=previous_packs)
+
+    # Create batch requests, skipping those with cached results
+    cache = stage.cache(load_ids=False)
     requests = []
+    submitted = []
+    items = 0
     
-    for i, row in df.iterrows():
-        # Create Claude request with structured output
-        request_params = {
-            "model": "claude-opus-4-1-20250805",
-            "max_tokens": 8192,
-            "system": prompts.triplets + "\n\nRespond with valid JSON matching this schema:\n" + 
-                     '{"cause": {"type": "string", "subtype": "string", "feature": "string"}, "relationship": "string", "effect": {"type": "string", "subtype": "string", "feature": "string"}, "net_outcome": "string"} OR {"skip": true}',
-            "messages": [{
-                "role": "user",
-                "content": row['finding']
-            }]
-        }
-        
-        requests.append(claude.create_request(f"{i}-{row['paper-id']}", request_params))
-
-    # Create and submit batch
-    batch = claude.gen_batch(client, requests)
-    
-    print(f"Batch ID: {batch['batch_object']}")
-    fetch.save(f"Batch ID: {batch['batch_object']}", "data/triplets/claude_batch_id.txt")
-    
-    return batch
-
-def get_results(batch_id=None):
-    """Get results from completed batch"""
-    if batch_id is None:
-        # Read batch ID from file
-        with open("data/triplets/claude_batch_id.txt", "r") as f:
-            batch_id = f.read().strip().replace("Batch ID: ", "")
-    
-    # Check batch status
-    batch_status = claude.get_batch_status(client, batch_id)
-    print(f"Batch status: {batch_status.processing_status}")
-    
-    if batch_status.processing_status != "ended":
-        print("Batch not completed yet")
-        return batch_status
-    
-    # Get results
-    res_path = "data/triplets/res.jsonl"
-    
-    # Clear existing results file
-    if os.path.exists(res_path):
-        os.remove(res_path)
-    
-    claude.get_batch_results(client, batch_id, res_path)
-    
-    # Process results
-    df = pd.DataFrame(columns=["paper-id", "cause", "relation", "effect", "net_outcome"])
-    df_keys = []
-    
-    with open(res_path, "r") as f:
-        for line in f:
-            if line.strip():
-                result = json.loads(line)
-                if result["result"]["type"] == "succeeded":
-                    custom_id = result["custom_id"]
-                    # Convert back to original format (i-paper-id -> i:paper-id)
-                    original_id = custom_id.replace("-", ":", 1) if "-" in custom_id else custom_id
-                    content_text = result["result"]["message"]["content"][0]["text"]
-                    
-                    try:
-                        # Parse the JSON response
-                        content_json = claude.extract_json_from_response(content_text)
-                        
-                        # Check if it's a skip response
-                        if content_json.get("skip", False):
-                            print(f"Skipped {original_id}: marked as non-interaction")
-                            continue
-                        
-                        # Convert to Triplet object
-                        content = Triplet(
-                            cause=Subject(**content_json["cause"]),
-                            relationship=content_json["relationship"],
-                            effect=Subject(**content_json["effect"]),
-                            net_outcome=content_json.get("net_outcome", "undetermined")
-                        )
-                        
-                        df.loc[len(df)] = [original_id, triplets.parse_subject(content.cause), str(content.relationship), triplets.parse_subject(content.effect), content.net_outcome]
-                        
-                        # Process keys
-                        df_keys += triplets.parse_key_list(content.cause)
-                        if("human|user" in triplets.parse_key_list(content.cause)):
-                            print(content.cause)
-                        df_keys += triplets.parse_key_list(content.effect)
-                        if("human|user" in triplets.parse_key_list(content.effect)):
-                            print(content.effect)
-
-                    except Exception as e:
-                        print(f"Error processing line ({original_id}): {e}")
+    if PACK == "1":
+        for i, row in df.iterrows():
+            params = request_params(row, max_tokens)
+            request = backend.create_request(f"{i}-{row['paper-id']}", params, cache=cache, cache_system=True)
+            if request:
+                requests.append(request)
+                submitted.append(params)
+                items += 1
+        if os.path.exists("data/triplets/packs.json"):
+            os.remove("data/triplets/packs.json")
+    else:
+        # Packed results are unpacked to the findings' custom_ids on ingest
+        packs = {}
+        for n, group in enumerate(pack_findings(df)):
+            params = pack_params(group, max_tokens)
+            packs[f"pack-{n}"] = [custom_id for custom_id, finding in group]
+            request = backend.create_request(f"pack-{n}", params, cache=cache, cache_system=True)
+            if request:
+                requests.append(request)
+                submitted.append(params)
+                items += len(group)
+        with open("data/triplets/packs.json", "w") as f:
+            json.dump(packs, f)
+        print(f"Packed {len(df)} findings into {len(packs)} requests")
+
+    return stage.submit(requests, submitted, cache, history, items=items, packs=previous_packs)
+
+def get_results(batch_ids=None, downloaded=False):
+    """Get results from completed batches; `downloaded` when they are already in res.jsonl"""
+    return stage.get_results(process_results, batch_ids, downloaded)
+
+def process_results():
+    """Write triplets.csv, the triplet store and keys.txt from res.jsonl"""
+    frames = results.ingest("data/triplets/res.jsonl", "triplets", packs=results.load_packs())
+    df, df_keys = frames["triplets"], frames["keys"]["key"].to_list()
     
     # Save results in same format as original
-    df_keys = set(df_keys)
-    fetch.save("\n".join([*df_keys]), "data/embeddings/keys.txt")
-    df.to_csv("data/triplets/triplets.csv", index=False)
+    os.makedirs("data/embeddings", exist_ok=True)
+    fetch.save("\n".join(df_keys), "data/embeddings/keys.txt")
+    results.write(df, "data/triplets/triplets.csv")
+    # Structured subjects and precomputed keys for the graph stage
+    TripletStore().write(df)
     
     print(f"Processed {len(df)} triplets")
     print(f"Generated {len(df_keys)} unique keys")
     
     return df, df_keys
 
-if __name__ == "__main__":
-    # Uncomment to create batch
-    # batch = main()
+def retry(max_tokens=16384, repair=True):
+    """Resubmit errored and unparseable results, with more output room and a repair instruction"""
+    def retry_requests(failed):
+        # Rebuild the original requests from the findings they were made from
+        df = pd.read_csv("./data/findings/findings.csv")
+        return [
+            backend.create_request(f"{i}-{row['paper-id']}", claude.retry_params(request_params(row), max_tokens, repair), cache_system=True)
+            for i, row in df.iterrows() if f"{i}-{row['paper-id']}" in failed
+        ]
     
-    # Uncomment to get results (after batch completes)
-    results = get_results()
\ No newline at end of file
+    # Findings of packed requests are retried one per request
+    return stage.retry(retry_requests, packs=results.load_packs())
+
+def get_retry_results(batch_ids=None, downloaded=False):
+    """Merge completed retry batches into res.jsonl and rewrite the stage outputs;
+    `downloaded` when they are already in res_retry.jsonl"""
+    return stage.get_retry_results(process_results, batch_ids, downloaded)
+
+if __name__ == "__main__":
+    # python "5. triplet-claude.py" [submit|retry|retry-results]; orchestrate.py runs all steps unattended
+    if "submit" in sys.argv[1:]:
+        batch = main()
+    elif "retry" in sys.argv[1:]:
+        batch = retry()
+    elif "retry-results" in sys.argv[1:]:
+        output = get_retry_results()
+    else:
+        # Get results (after batches complete)
+        output = get_results()
\ No newline at end of file
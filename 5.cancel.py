@@ -1,4 +1,5 @@
 from anthropic import Anthropic
+import functions.claude as claude
 import os
 import dotenv
 
@@ -6,17 +7,8 @@ dotenv.load_dotenv()
 
 client = Anthropic()
 
-def cancel_batch(batch_id=None):
+def cancel_batch(batch_id):
     """Cancel a Claude batch"""
-    if batch_id is None:
-        # Read batch ID from file
-        try:
-            with open("data/triplets/claude_batch_id.txt", "r") as f:
-                batch_id = f.read().strip().replace("Batch ID: ", "")
-        except FileNotFoundError:
-            print("No batch ID file found. Please provide batch ID manually.")
-            return
-    
     try:
         # Get batch status first
         batch_status = client.beta.messages.batches.retrieve(batch_id)
@@ -37,6 +29,14 @@ def cancel_batch(batch_id=None):
         print(f"Error canceling batch {batch_id}: {e}")
         return None
 
+def cancel_batches(manifest_path="data/triplets/manifest.json"):
+    """Cancel every batch recorded in a stage manifest"""
+    if not os.path.exists(manifest_path):
+        print("No manifest found. Please provide batch ID manually.")
+        return
+    
+    return [cancel_batch(batch_id) for batch_id in claude.load_manifest(manifest_path)]
+
 if __name__ == "__main__":
-    # Cancel the current batch
-    result = cancel_batch()
\ No newline at end of file
+    # Cancel the current batches
+    result = cancel_batches()
\ No newline at end of file
@@ -1,67 +1,176 @@
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
 import json
 import functions.fetch as fetch
+import functions.planner as planner
+from functions.backend import retry_after
+from functions.ratelimit import AdaptiveBatch, AdaptiveConcurrency, TokenBucket
+from collections import Counter, deque
+from functions.store import EmbeddingStore
+import functions.embeddings as emb
 import pandas as pd
 import os
 import dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
 import time
 
 dotenv.load_dotenv()
 
 import importlib
 importlib.reload(fetch)
+importlib.reload(planner)
+importlib.reload(emb)
 
-# Create DeepInfra client
-client = OpenAI(
+# Create DeepInfra client; failed calls are retried by embed_keys, which paces every worker
+client = AsyncOpenAI(
     api_key=os.getenv("DEEPINFRA_API_KEY"),
     base_url="https://api.deepinfra.com/v1/openai",
+    max_retries=0,
 )
 
-model = "Qwen/Qwen3-Embedding-8B"
+# Stores are per model; EMBEDDING_MODEL selects the one merge and cluster read
+model = emb.MODEL
 
-def get_embedding(text, retry_count=3):
-    """Get embedding for a single text with retry logic"""
-    for attempt in range(retry_count):
-        try:
-            response = client.embeddings.create(
-                model=model,
-                input=text,
-                encoding_format="float"
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Attempt {attempt + 1} failed for text: {text[:50]}... Error: {e}")
-            if attempt < retry_count - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-            else:
-                print(f"Failed to get embedding after {retry_count} attempts")
-                return None
+# Upper bound of estimated input tokens per embeddings request
+MAX_BATCH_TOKENS = 16000
+
+# Calls in flight, requests per minute and tokens per minute of the
+# embeddings endpoint; set to the account's rate limits
+EMBEDDING_LIMITS = {
+    "concurrency": int(os.getenv("EMBEDDING_CONCURRENCY", "32")),
+    "rpm": int(os.getenv("EMBEDDING_RPM", "600")),
+    "tpm": int(os.getenv("EMBEDDING_TPM", "1000000")),
+}
+
+async def get_embeddings(texts):
+    """Embeddings of several texts from one request, in input order"""
+    response = await client.embeddings.create(
+        model=model,
+        input=texts,
+        encoding_format="float"
+    )
+    embeddings = [None] * len(texts)
+    for item in response.data:
+        embeddings[item.index] = item.embedding
+    if any(e is None for e in embeddings):
+        raise ValueError(f"Response has {len(response.data)} embeddings for {len(texts)} inputs")
+    return embeddings
+
+def take_batch(queue, sizer):
+    """Next batch from the queue: at most sizer.size keys and MAX_BATCH_TOKENS estimated tokens"""
+    batch, tokens = [], 0
+    while queue and len(batch) < sizer.size:
+        item_tokens = planner.count_tokens(queue[0])
+        if batch and tokens + item_tokens > MAX_BATCH_TOKENS:
+            break
+        batch.append(queue.popleft())
+        tokens += item_tokens
+    return batch, tokens
 
-def process_embedding_batch(items, max_workers=100):
-    """Process embeddings using ThreadPoolExecutor"""
-    results = []
+async def embed_keys(keys, store, limits=EMBEDDING_LIMITS, retries=5, report_every=5.0):
+    """Embed keys in a continuous pipeline, appending each finished batch to the store.
+
+    A worker takes an AdaptiveConcurrency slot before cutting its batch, so
+    batches are sized by the AdaptiveBatch as it stands when a call can
+    start. Every call also waits on request and token buckets refilled at
+    the limits' rpm and tpm. A rate-limited call empties both buckets,
+    shrinks the batch size and concurrency, and is retried after retry-after
+    (or an exponential backoff); a batch still rate limited after `retries`
+    attempts goes back to the front of the queue, to be cut again at the
+    smaller size. Timeouts, dropped connections and 5xx errors are retried
+    with the exponential backoff. A batch that keeps failing, or fails
+    otherwise, is split, and only its failing half is retried, down to
+    single keys. Progress and throughput are printed every `report_every`
+    seconds.
+    """
+    queue = deque(keys)
+    sizer = AdaptiveBatch()
+    request_bucket, token_bucket = TokenBucket(limits["rpm"]), TokenBucket(limits["tpm"])
+    limit = AdaptiveConcurrency(maximum=limits["concurrency"])
+    counts = Counter()
+    requeued = Counter()
+    start = last_report = time.monotonic()
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_item = {
-            executor.submit(get_embedding, item): item 
-            for item in items
-        }
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_item):
-            item = future_to_item[future]
+    def report():
+        elapsed = time.monotonic() - start
+        print(f"Embedded {counts['embedded']}/{len(keys)} keys, {counts['embedded'] / elapsed:.0f} keys/s, {counts['calls'] / elapsed * 60:.0f} calls/min, "
+              f"{sizer.size} keys per call, {limit.in_flight}/{limit.limit} in flight, {counts['rate_limited']} rate limited, {counts['failed']} failed")
+    
+    async def embed(texts, tokens, held=False):
+        """Embeddings of a batch by key; `held` when the caller already holds a slot for the first attempt"""
+        for attempt in range(retries):
+            if not held:
+                await limit.acquire()
+            held = False
             try:
-                embedding = future.result()
-                if embedding is not None:
-                    results.append({"id": item, "embedding": embedding})
-                else:
-                    print(f"Failed to get embedding for: {item}")
+                await request_bucket.acquire()
+                await token_bucket.acquire(tokens)
+                counts["calls"] += 1
+                call_start = time.monotonic()
+                embeddings = await get_embeddings(texts)
+            except RateLimitError as e:
+                counts["rate_limited"] += 1
+                request_bucket.drain()
+                token_bucket.drain()
+                sizer.throttled()
+                limit.throttled()
+                rate_limited = True
+                wait = retry_after(e.response) or 2 ** attempt
+            except (APIConnectionError, InternalServerError) as e:
+                # Transient: the same batch may succeed on a later attempt
+                print(f"Attempt {attempt + 1} failed for batch of {len(texts)} texts, retrying: {e}")
+                rate_limited = False
+                wait = 2 ** attempt
             except Exception as e:
-                print(f"Error processing {item}: {e}")
+                print(f"Attempt {attempt + 1} failed for batch of {len(texts)} texts: {e}")
+                rate_limited = False
+                break
+            else:
+                sizer.record(len(texts), time.monotonic() - call_start)
+                limit.succeeded()
+                return dict(zip(texts, embeddings))
+            finally:
+                await limit.release()
+            if attempt + 1 < retries:
+                await asyncio.sleep(wait)
+        
+        if rate_limited and requeued[texts[0]] < retries:
+            # Splitting would only add requests while throttled: cut the keys again later
+            for t in texts:
+                requeued[t] += 1
+            queue.extendleft(reversed(texts))
+            return {}
+        if len(texts) == 1:
+            counts["failed"] += 1
+            print(f"Failed to get embedding for: {texts[0][:50]}")
+            return {}
+        half = len(texts) // 2
+        first, second = await asyncio.gather(
+            embed(texts[:half], sum(planner.count_tokens(t) for t in texts[:half])),
+            embed(texts[half:], sum(planner.count_tokens(t) for t in texts[half:]))
+        )
+        return first | second
     
-    return results
+    async def worker():
+        nonlocal last_report
+        while queue:
+            # The batch is cut once a call can start, at the batch size of that moment
+            await limit.acquire()
+            if not queue:
+                await limit.release()
+                break
+            batch, tokens = take_batch(queue, sizer)
+            results = await embed(batch, tokens, held=True)
+            if results:
+                # Streamed to the store as each batch finishes; an interrupted run resumes from here
+                store.append(list(results), list(results.values()))
+                counts["embedded"] += len(results)
+            if queue and time.monotonic() - last_report >= report_every:
+                last_report = time.monotonic()
+                report()
+    
+    await asyncio.gather(*[worker() for _ in range(limits["concurrency"])])
+    report()
+    return dict(counts)
 
 def main():
     """Main function to create embeddings from keys.txt"""
@@ -79,32 +188,20 @@ def main():
         print("No keys found in keys.txt")
         return
     
-    print(f"Processing {len(keys)} keys for embeddings...")
-    
-    # Process embeddings in batches
-    batch_size = 50  # Adjust based on API limits
-    all_results = []
-    
-    for i in range(0, len(keys), batch_size):
-        batch = keys[i:i + batch_size]
-        print(f"Processing batch {i//batch_size + 1}/{(len(keys) + batch_size - 1)//batch_size}")
-        
-        batch_results = process_embedding_batch(batch)
-        all_results.extend(batch_results)
-        
-        # Add delay between batches to respect rate limits
-        if i + batch_size < len(keys):
-            time.sleep(1)
+    # Only keys not embedded by this model in an earlier run are sent
+    keys = list(dict.fromkeys(keys))
+    store = EmbeddingStore(model)
+    missing = store.missing(keys)
+    print(f"Stored: {len(keys) - len(missing)}, to embed: {len(missing)} of {len(keys)} keys")
     
-    # Create DataFrame and save results
-    df = pd.DataFrame(all_results)
+    if missing:
+        asyncio.run(embed_keys(missing, store))
     
-    # Save to CSV in same format as original
-    output_path = "data/embeddings/embeddings.csv"
-    df.to_csv(output_path, index=False)
+    # The store is the output: merge and cluster memory-map it through emb.load_embeddings
+    df = pd.DataFrame({"id": [k for k in keys if k in store]})
     
     print(f"Processed {len(df)} embeddings")
-    print(f"Saved embeddings to {output_path}")
+    print(f"Embeddings stored in {store.path}")
     
     return df
 
@@ -115,15 +212,20 @@ def process_existing_jsonl():
         print(f"No existing {jsonl_path} found")
         return None
     
-    df = pd.DataFrame(columns=["id", "embedding"])
+    ids, vectors = [], []
     
     with open(jsonl_path, "r") as f:
         for line in f:
             if line.strip():
                 data = json.loads(line)
-                df.loc[len(df)] = [data['custom_id'], data['response']['body']['data'][0]['embedding']]
+                ids.append(data['custom_id'])
+                vectors.append(data['response']['body']['data'][0]['embedding'])
     
-    df.to_csv("data/embeddings/embeddings.csv", index=False)
+    # The JSONL is the OpenAI batch output of "6. embedding.ipynb"; stored under
+    # its model, read by merge and cluster with EMBEDDING_MODEL=text-embedding-3-large
+    df = pd.DataFrame({"id": ids}).drop_duplicates("id")
+    if len(df):
+        EmbeddingStore("text-embedding-3-large").append(df["id"].to_list(), [vectors[i] for i in df.index])
     print(f"Processed {len(df)} embeddings from existing JSONL")
     return df
 
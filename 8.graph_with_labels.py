@@ -3,18 +3,27 @@ import networkx as nx
 import json
 import ast
 import functions.triplets as ft
+from functions.store import AbstractStore, TripletStore
 import importlib
 
 importlib.reload(ft)
 
+def load_triplets():
+    """Projected triplet columns with precomputed keys; subjects themselves are not loaded"""
+    store = TripletStore()
+    if not store.exists():
+        # Triplets ingested before the store existed
+        store.write(pd.read_csv('data/triplets/triplets.csv'))
+    return store.read(columns=['paper-id', 'relation', 'cause_full', 'cause_short', 'effect_full', 'effect_short'])
+
 def load_data():
     """Load all required data files"""
     ref = pd.read_csv('data/findings/ref.csv')
-    abstract = pd.read_csv('data/abstract/abstract.csv')
+    abstract = AbstractStore().read(columns=["paperId", "title"])
     findings = pd.read_csv('data/findings/findings.csv')
     merged_keys = pd.read_csv('data/graph/merged_keys.csv')
     clustered_keys = pd.read_csv('data/graph/clustered_keys.csv')
-    triplets = pd.read_csv('data/triplets/triplets.csv')
+    triplets = load_triplets()
     
     # Load cluster labels if available
     try:
@@ -28,21 +37,15 @@ def load_data():
 def prepare_data(findings, triplets, ref, abstract):
     """Prepare data for graph creation"""
     # Add keys to findings
-    for i, row in findings.iterrows():
-        findings.at[i, 'key'] = f"{i}:{row['paper-id']}"
-    
-    # Process triplets
-    triplets['cause'] = triplets['cause'].apply(lambda x: json.loads(x))
-    triplets['effect'] = triplets['effect'].apply(lambda x: json.loads(x))
-    
-    for t in ['cause', 'effect']:
-        triplets[f"{t}_full"] = triplets[t].apply(lambda x: ft.parse_key(x, full=True))
-        triplets[f"{t}_short"] = triplets[t].apply(lambda x: ft.parse_key(x))
+    findings['key'] = findings.index.astype(str) + ":" + findings['paper-id']
     
-    # Add paper information
-    triplets['ref-id'] = triplets['paper-id'].apply(lambda x: ref[ref['ref_id'] == x.split(":")[1]].iloc[0]['id'])
-    triplets['paper'] = triplets['ref-id'].apply(lambda x: abstract[abstract['paperId'] == x].iloc[0]['title'])
-    triplets['finding'] = triplets['paper-id'].apply(lambda x: findings[findings['key'] == x].iloc[0]['finding'])
+    # Paper information joined by lookup tables; cause/effect keys come precomputed from the store
+    ref_ids = ref.drop_duplicates('ref_id').set_index('ref_id')['id']
+    titles = abstract.drop_duplicates('paperId').set_index('paperId')['title']
+    finding_text = findings.drop_duplicates('key').set_index('key')['finding']
+    triplets['ref-id'] = triplets['paper-id'].str.split(":").str[1].map(ref_ids)
+    triplets['paper'] = triplets['ref-id'].map(titles)
+    triplets['finding'] = triplets['paper-id'].map(finding_text)
     
     return findings, triplets
 
@@ -79,17 +82,16 @@ def create_graph_with_labels(clustered_keys, merged_keys, triplets, cluster_labe
         )
     
     # Add edges from triplets
-    for i, f in triplets.iterrows():
-        source = merged_map[f['cause_short']] if f['cause_short'] in merged_map else f['cause_short']
-        target = merged_map[f['effect_short']] if f['effect_short'] in merged_map else f['effect_short']
+    edges = zip(triplets['cause_short'], triplets['effect_short'], triplets['cause_full'], triplets['effect_full'], triplets['relation'], triplets['paper'], triplets['finding'])
+    for cause_short, effect_short, cause_full, effect_full, relation, paper, finding in edges:
         G.add_edge(
-            source, target,
+            merged_map.get(cause_short, cause_short), merged_map.get(effect_short, effect_short),
             kind="relation",
-            source_full=f['cause_full'],
-            effect_full=f['effect_full'],
-            type=f['relation'],
-            paper=f['paper'],
-            finding=f['finding']
+            source_full=cause_full,
+            effect_full=effect_full,
+            type=relation,
+            paper=paper,
+            finding=finding
         )
     
     # Add cluster nodes with enhanced labels
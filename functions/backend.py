@@ -0,0 +1,416 @@
+import functions.claude as claude
+import functions.llm as llm
+import functions.planner as planner
+from functions.ratelimit import TokenBucket
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+class BatchStatus(BaseModel):
+    id: str
+    processing_status: str # "ended" once no request is still processing
+    processing: int = 0
+    succeeded: int = 0
+    errored: int = 0
+
+class RateLimited(Exception):
+    """A real-time request was rejected by the provider's rate limits"""
+    def __init__(self, retry_after=None):
+        super().__init__(f"Rate limited (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+def retry_after(response):
+    """Seconds from a 429 response's retry-after header, if any"""
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def error_result(custom_id, error_type, message):
+    return {"custom_id": custom_id, "result": {"type": "errored", "error": {"type": error_type, "message": message}}}
+
+# Work of at most this many requests runs in real time instead of as batches
+REALTIME_MAX = int(os.getenv("REALTIME_MAX_REQUESTS", "200"))
+
+# Open calls, requests per minute and tokens per minute of real-time runs;
+# set to the account's rate limits for the model
+REALTIME_LIMITS = {
+    "concurrency": int(os.getenv("LLM_CONCURRENCY", "16")),
+    "rpm": int(os.getenv("LLM_RPM", "1000")),
+    "tpm": int(os.getenv("LLM_TPM", "400000")),
+}
+
+class Backend:
+    """Build request -> submit -> poll -> stream results, independent of provider.
+
+    Requests are built from Anthropic-style params (model, max_tokens, system,
+    messages) and results are written to res.jsonl in the Anthropic result
+    format, so the stage scripts and results ingestion work with any backend.
+    `model` replaces the model named in the params when set.
+    """
+    model = None
+
+    def params(self, params):
+        return {**params, "model": self.model} if self.model else params
+
+    def create_request(self, custom_id, params, cache=None, cache_system=False):
+        params = self.params(params)
+        if cache is not None and cache.lookup(custom_id, params) is not None:
+            return None
+        return self.build(custom_id, params, cache_system)
+
+    def gen_batches(self, requests, manifest_path, **kwargs):
+        return claude.submit_shards(self.submit, requests, manifest_path, **kwargs)
+
+    def get_batches_status(self, batch_ids, workers=8):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.status, batch_ids))
+
+    def get_batch_results(self, batch_id, path=None, cache=None):
+        return claude.write_results(batch_id, self.results(batch_id), path, cache)
+
+    def tokens(self, request):
+        """Prompt plus reserved output tokens of a request, as counted against tokens-per-minute limits"""
+        params = request["params"]
+        return sum(planner.prompt_tokens(params)) + params["max_tokens"]
+
+    async def run_realtime(self, requests, path, cache=None, concurrency=REALTIME_LIMITS["concurrency"],
+                           rpm=REALTIME_LIMITS["rpm"], tpm=REALTIME_LIMITS["tpm"], retries=5):
+        """Send requests as individual calls and append each result to `path` as it arrives.
+
+        At most `concurrency` calls are open at once, and starts are paced by
+        request and token buckets refilled at `rpm` and `tpm`. A rate-limited
+        call empties both buckets and is retried after the provider's
+        retry-after (or an exponential backoff), up to `retries` attempts;
+        other failures are written as errored results for the retry batch.
+        Requests already in `path` are skipped, so an interrupted run resumes.
+        """
+        claude.repair_results(path)
+        done = {result["custom_id"] for result in claude.read_results(path)}
+        pending = [request for request in requests if request["custom_id"] not in done]
+        request_bucket, token_bucket = TokenBucket(rpm), TokenBucket(tpm)
+        semaphore = asyncio.Semaphore(concurrency)
+        counts = Counter()
+        start = time.monotonic()
+
+        async def run_one(request):
+            async with semaphore:
+                for attempt in range(retries):
+                    await request_bucket.acquire()
+                    await token_bucket.acquire(self.tokens(request))
+                    try:
+                        return await self.complete(request)
+                    except RateLimited as e:
+                        counts["rate_limited"] += 1
+                        request_bucket.drain()
+                        token_bucket.drain()
+                        await asyncio.sleep(e.retry_after or 2 ** attempt)
+                    except Exception as e:
+                        return error_result(request["custom_id"], "api_error", str(e))
+                return error_result(request["custom_id"], "rate_limit_error", f"Rate limited {retries} times")
+
+        f = claude.open_results(path, "a")
+        try:
+            for future in asyncio.as_completed([run_one(request) for request in pending]):
+                result = await future
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                if cache is not None and result["result"]["type"] == "succeeded":
+                    cache.put(result["custom_id"], result["result"])
+                counts[result["result"]["type"]] += 1
+                finished = counts["succeeded"] + counts["errored"]
+                if finished % 50 == 0 or finished == len(pending):
+                    print(f"Real-time: {finished}/{len(pending)} done, {counts['errored']} errored, {counts['rate_limited']} rate limited, {finished / (time.monotonic() - start):.1f} requests/s")
+        finally:
+            f.close()
+            if cache is not None:
+                cache.close()
+
+        return dict(counts)
+
+    def dispatch(self, requests, manifest_path, path, cache=None, mode=None):
+        """Submit requests as batches, or run them in real time into `path` when there are few.
+
+        `mode` ("batch" or "realtime") defaults to LLM_MODE, then to real time
+        for at most REALTIME_MAX requests. A real-time run leaves no manifest,
+        so fetching results finds no batches and only merges cached results.
+        """
+        mode = mode or os.getenv("LLM_MODE") or ("realtime" if len(requests) <= REALTIME_MAX else "batch")
+        if mode == "batch":
+            return self.gen_batches(requests, manifest_path)
+
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        print(f"Running {len(requests)} requests in real time")
+        return {"batches": [], "realtime": asyncio.run(self.run_realtime(requests, path, cache))}
+
+class AnthropicBackend(Backend):
+    def __init__(self, client=None, model=None):
+        from anthropic import Anthropic
+        self.client = client or Anthropic()
+        self.async_client = None
+        self.model = model
+
+    def build(self, custom_id, params, cache_system):
+        return claude.create_request(custom_id, params, cache_system=cache_system)
+
+    def submit(self, shard):
+        return claude.gen_batch(self.client, shard)["batch_object"]
+
+    def status(self, batch_id):
+        batch = claude.get_batch_status(self.client, batch_id)
+        return BatchStatus(
+            id=batch.id,
+            processing_status=batch.processing_status,
+            processing=batch.request_counts.processing,
+            succeeded=batch.request_counts.succeeded,
+            errored=batch.request_counts.errored
+        )
+
+    def results(self, batch_id):
+        return (claude.result_to_dict(result) for result in self.client.messages.batches.results(batch_id))
+
+    async def complete(self, request):
+        from anthropic import AsyncAnthropic, RateLimitError
+        if self.async_client is None:
+            # Rate limits are retried by run_realtime, which paces every caller
+            self.async_client = AsyncAnthropic(max_retries=0)
+        try:
+            message = await self.async_client.messages.create(**request["params"])
+        except RateLimitError as e:
+            raise RateLimited(retry_after(e.response))
+        return {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": claude.message_to_dict(message)}}
+
+class OpenAIBackend(Backend):
+    """Chat completions batches through functions/llm.py"""
+    def __init__(self, client=None, model="o3-mini"):
+        from openai import OpenAI
+        self.client = client or OpenAI()
+        self.async_client = None
+        self.model = model
+
+    def build(self, custom_id, params, cache_system):
+        # OpenAI caches repeated prompt prefixes automatically
+        messages = [{"role": "system", "content": params["system"]}] if params.get("system") else []
+        return llm.wrap(custom_id, {
+            "model": params["model"],
+            "max_completion_tokens": params["max_tokens"],
+            "messages": messages + params["messages"]
+        })
+
+    def submit(self, shard):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "req.jsonl")
+            llm.gen_batch_jsonl(path, shard)
+            return llm.gen_batch(self.client, path)["batch_object"]
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        ended = batch.status in ["completed", "failed", "expired", "cancelled"]
+        return BatchStatus(
+            id=batch.id,
+            processing_status="ended" if ended else batch.status,
+            processing=(counts.total - counts.completed - counts.failed) if counts and not ended else 0,
+            succeeded=counts.completed if counts else 0,
+            errored=counts.failed if counts else 0
+        )
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield self.result_to_dict(json.loads(line))
+
+    def tokens(self, request):
+        body = request["body"]
+        return sum(planner.count_tokens(planner.text_of(message["content"])) for message in body["messages"]) + body["max_completion_tokens"]
+
+    async def complete(self, request):
+        from openai import AsyncOpenAI, RateLimitError
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(max_retries=0)
+        try:
+            completion = await self.async_client.chat.completions.create(**request["body"])
+        except RateLimitError as e:
+            raise RateLimited(retry_after(e.response))
+        return self.result_to_dict({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": completion.model_dump()}})
+
+    @staticmethod
+    def result_to_dict(line):
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") != 200 or "choices" not in body:
+            error = line.get("error") or body.get("error") or {}
+            return {"custom_id": line["custom_id"], "result": {"type": "errored", "error": {
+                "type": error.get("code") or "api_error",
+                "message": error.get("message", "")
+            }}}
+        choice = body["choices"][0]
+        return {"custom_id": line["custom_id"], "result": {"type": "succeeded", "message": {
+            "id": body.get("id"),
+            "content": [{"type": "text", "text": choice["message"]["content"] or ""}],
+            "role": "assistant",
+            "model": body.get("model"),
+            "stop_reason": choice.get("finish_reason"),
+            "usage": {
+                "input_tokens": body["usage"]["prompt_tokens"],
+                "output_tokens": body["usage"]["completion_tokens"]
+            }
+        }}}
+
+MOCK_RESPONSES = {
+    "findings": {"keywords": ["Education"], "summaries": ["AI tutoring systems increase student learning outcomes"], "note": {"type": "", "description": ""}},
+    "triplets": {"cause": {"type": "ai", "subtype": "llm", "feature": "tutoring"}, "relationship": "INCREASES", "effect": {"type": "human", "subtype": "student", "feature": "learning"}, "net_outcome": "positive"},
+}
+
+def mock_response(params):
+    """Canned answer matching the schema named in the system prompt"""
+    system = params["system"] if isinstance(params["system"], str) else params["system"][0]["text"]
+    if '{"results": [' in system:
+        ids = re.findall(r'<finding id="([^"]+)">', params["messages"][0]["content"])
+        return json.dumps({"results": [{"id": i, **MOCK_RESPONSES["triplets"]} for i in ids]})
+    if '"triplets": [' in system:
+        findings = MOCK_RESPONSES["findings"]
+        return json.dumps({**findings, "triplets": [MOCK_RESPONSES["triplets"]] * len(findings["summaries"])})
+    return json.dumps(MOCK_RESPONSES["triplets" if '"skip": true' in system else "findings"])
+
+class MockBackend(Backend):
+    """Offline batches that end `latency` seconds after submission.
+
+    A share of requests fails as rate-limited (`rate_limit_rate`) or with an
+    API error (`error_rate`), and a share succeeds with a truncated answer
+    (`garble_rate`). `max_in_flight` caps unfinished batches, with
+    submissions waiting for a slot like a rate-limited upload.
+    """
+    def __init__(self, latency=5.0, error_rate=0.02, rate_limit_rate=0.02, garble_rate=0.02,
+                 max_in_flight=None, responder=mock_response, model=None, seed=0, realtime_latency=0.05):
+        self.latency = latency
+        self.realtime_latency = realtime_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.garble_rate = garble_rate
+        self.max_in_flight = max_in_flight
+        self.responder = responder
+        self.model = model
+        self.random = random.Random(seed)
+        self.ids = itertools.count()
+        self.batches = {}
+
+    def build(self, custom_id, params, cache_system):
+        return {"custom_id": custom_id, "params": params}
+
+    def in_flight(self):
+        now = time.monotonic()
+        return sum(1 for batch in self.batches.values() if batch["ends"] > now)
+
+    def submit(self, shard):
+        while self.max_in_flight and self.in_flight() >= self.max_in_flight:
+            time.sleep(0.05)
+        batch_id = f"mock_{next(self.ids)}"
+        self.batches[batch_id] = {"requests": shard, "ends": time.monotonic() + self.latency}
+        return batch_id
+
+    def status(self, batch_id):
+        batch = self.batches[batch_id]
+        ended = time.monotonic() >= batch["ends"]
+        return BatchStatus(
+            id=batch_id,
+            processing_status="ended" if ended else "in_progress",
+            processing=0 if ended else len(batch["requests"])
+        )
+
+    def respond(self, request, roll):
+        """Simulated result of one request for a roll in [rate_limit_rate, 1)"""
+        if roll < self.rate_limit_rate + self.error_rate:
+            return error_result(request["custom_id"], "api_error", "Simulated failure")
+
+        text = self.responder(request["params"])
+        if roll < self.rate_limit_rate + self.error_rate + self.garble_rate:
+            text = text[:len(text) // 3]
+        return {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": {
+            "id": f"msg_{request['custom_id']}",
+            "content": [{"type": "text", "text": text}],
+            "role": "assistant",
+            "model": request["params"]["model"],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": len(json.dumps(request["params"])) // 4, "output_tokens": len(text) // 4}
+        }}}
+
+    def results(self, batch_id):
+        for request in self.batches[batch_id]["requests"]:
+            roll = self.random.random()
+            if roll < self.rate_limit_rate:
+                yield error_result(request["custom_id"], "rate_limit_error", "Simulated rate limit")
+            else:
+                yield self.respond(request, roll)
+
+    async def complete(self, request):
+        await asyncio.sleep(self.realtime_latency)
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            raise RateLimited(self.realtime_latency)
+        return self.respond(request, roll)
+
+BACKENDS = {"anthropic": AnthropicBackend, "openai": OpenAIBackend, "mock": MockBackend}
+
+# One shared instance per backend, so scripts loaded into the same process
+# (orchestrate.py) see each other's batches, including the mock's in-memory ones
+instances = {}
+
+def get_backend(name=None, **kwargs):
+    """Backend named by `name` or the LLM_BACKEND environment variable (anthropic, openai, mock).
+
+    LLM_MODEL, when set, replaces the model named in each stage's request params.
+    """
+    name = name or os.getenv("LLM_BACKEND", "anthropic")
+    if kwargs or name not in instances:
+        if os.getenv("LLM_MODEL"):
+            kwargs.setdefault("model", os.getenv("LLM_MODEL"))
+        instances[name] = BACKENDS[name](**kwargs)
+    return instances[name]
+
+def benchmark_backend(requests=10000, shard=1000, latency=1.0, poll=0.25):
+    """Time build -> submit -> poll -> download -> ingest for findings requests on the mock backend"""
+    import functions.results as results
+    backend = MockBackend(latency=latency)
+    params = {"model": "mock", "max_tokens": 1024, "system": "findings", "messages": [{"role": "user", "content": "abstract"}]}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        built = [backend.create_request(f"paper-{i}", params) for i in range(requests)]
+        manifest = backend.gen_batches(built, os.path.join(tmp, "manifest.json"), max_count=shard)
+        batch_ids = [batch["id"] for batch in manifest["batches"]]
+        submitted = time.perf_counter()
+
+        res_path = os.path.join(tmp, "res.jsonl")
+        pending = set(batch_ids)
+        while pending:
+            for status in backend.get_batches_status(sorted(pending)):
+                if status.processing_status == "ended":
+                    backend.get_batch_results(status.id, res_path)
+                    pending.discard(status.id)
+            if pending:
+                time.sleep(poll)
+        downloaded = time.perf_counter()
+
+        frames = results.ingest(res_path, "findings")
+        done = time.perf_counter()
+
+    print(f"{requests} requests in {len(batch_ids)} batches @ {latency}s simulated latency")
+    print(f"- build + submit: {submitted - start:.2f}s")
+    print(f"- poll + download: {downloaded - submitted:.2f}s")
+    print(f"- ingest: {done - downloaded:.2f}s ({len(frames['res'])} rows)")
+    print(f"- total: {done - start:.2f}s, {requests / (done - start):.0f} requests/s")
+    return {"submit": submitted - start, "download": downloaded - submitted, "ingest": done - downloaded}
@@ -1,10 +1,90 @@
 import json
+import gzip
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import os
 import re
+from functools import lru_cache
+from typing import get_args
+from pydantic import TypeAdapter, ValidationError
 from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
 from anthropic.types.messages.batch_create_params import Request
 
-def create_request(custom_id, params):
-    """Create a batch request object"""
+class ResultCache:
+    """Persistent batch results keyed by a hash of the request content.
+
+    `ids` maps the custom_ids of the current run to their content keys; it is
+    saved by the request builder and reloaded when results are fetched.
+    """
+    def __init__(self, path, load_ids=True):
+        self.path = path
+        self.ids_path = os.path.splitext(path)[0] + "_ids.json"
+        self.results = {}
+        self.ids = {}
+        self.file = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        if not self.cut_off(entry["result"]):
+                            self.results[entry["key"]] = entry["result"]
+        if load_ids and os.path.exists(self.ids_path):
+            with open(self.ids_path, "r") as f:
+                self.ids = json.load(f)
+
+    @staticmethod
+    def cut_off(result):
+        """Answers that hit max_tokens are never cached: they depend on the cap of the run"""
+        return result.get("type") == "succeeded" and result["message"].get("stop_reason") == "max_tokens"
+
+    @staticmethod
+    def key(params):
+        # max_tokens is left out so a re-planned output cap keeps cache hits;
+        # that is safe because only complete answers are cached (see cut_off)
+        content = {k: params.get(k) for k in ["model", "system", "messages"]}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, custom_id, params):
+        """Remember which content custom_id stands for and return its cached result"""
+        key = self.key(params)
+        self.ids[custom_id] = key
+        return self.results.get(key)
+
+    def put(self, custom_id, result, replace=False):
+        key = self.ids.get(custom_id)
+        if key is None or (key in self.results and not replace) or self.cut_off(result):
+            return
+        self.results[key] = result
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps({"key": key, "result": result}) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def save_ids(self):
+        with open(self.ids_path, "w") as f:
+            json.dump(self.ids, f)
+
+def create_request(custom_id, params, cache=None, cache_system=False):
+    """Create a batch request object, or None if `cache` already holds its result.
+
+    With `cache_system`, the system prompt is marked for prompt caching so the
+    prefix shared by every request of a stage is billed and processed once.
+    """
+    if cache is not None and cache.lookup(custom_id, params) is not None:
+        return None
+    if cache_system and isinstance(params.get("system"), str):
+        params = {**params, "system": [{
+            "type": "text",
+            "text": params["system"],
+            "cache_control": {"type": "ephemeral"}
+        }]}
     return Request(
         custom_id=custom_id,
         params=MessageCreateParamsNonStreaming(**params)
@@ -21,87 +101,456 @@ def gen_batch(client, requests):
         "batch": batch_object
     }
 
+def shard_requests(requests, max_count=100000, max_bytes=200 * 1024 * 1024):
+    """Split requests into shards under the per-batch request count and payload size"""
+    shards = [[]]
+    size = 0
+    for request in requests:
+        request_size = len(json.dumps(request))
+        if shards[-1] and (len(shards[-1]) >= max_count or size + request_size > max_bytes):
+            shards.append([])
+            size = 0
+        shards[-1].append(request)
+        size += request_size
+    return [shard for shard in shards if shard]
+
+def submit_shards(submit, requests, manifest_path, max_count=100000, max_bytes=200 * 1024 * 1024, workers=4):
+    """Upload shards concurrently with `submit(shard) -> batch ID` and record them in a manifest"""
+    shards = shard_requests(requests, max_count=max_count, max_bytes=max_bytes)
+    print(f"Submitting {len(requests)} requests in {len(shards)} batches")
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_ids = list(executor.map(submit, shards))
+    
+    manifest = {
+        "batches": [{
+            "id": batch_id,
+            "count": len(shard),
+            "first_custom_id": shard[0]["custom_id"],
+            "last_custom_id": shard[-1]["custom_id"]
+        } for batch_id, shard in zip(batch_ids, shards)]
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    
+    return manifest
+
+def gen_batches(client, requests, manifest_path, **kwargs):
+    """Submit requests as concurrently uploaded shards and record them in a manifest"""
+    return submit_shards(lambda shard: gen_batch(client, shard)["batch_object"], requests, manifest_path, **kwargs)
+
+def load_manifest(manifest_path):
+    """Return the batch IDs recorded in a manifest"""
+    with open(manifest_path, "r") as f:
+        return [batch["id"] for batch in json.load(f)["batches"]]
+
 def get_batch_status(client, batch_id):
     """Get batch processing status"""
     return client.messages.batches.retrieve(batch_id)
+
+def get_batches_status(client, batch_ids, workers=8):
+    """Get processing status of several batches concurrently"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda batch_id: get_batch_status(client, batch_id), batch_ids))
     
-def get_batch_results(client, batch_id, path=None):
-    """Get batch results, optionally saving to file"""
-    results = []
+def message_to_dict(message):
+    """Convert a Message into the form stored in res.jsonl"""
+    # Handle empty content array
+    content_text = ""
+    if message.content and len(message.content) > 0:
+        content_text = message.content[0].text
     
-    for result in client.messages.batches.results(batch_id):
-        results.append(result)
-        
-        if path:
-            # Append each result to file as JSONL
-            with open(path, "a") as f:
-                result_dict = {
-                    "custom_id": result.custom_id,
-                    "result": {
-                        "type": result.result.type
-                    }
-                }
-                
-                if result.result.type == "succeeded":
-                    # Handle empty content array
-                    content_text = ""
-                    if result.result.message.content and len(result.result.message.content) > 0:
-                        content_text = result.result.message.content[0].text
-                    
-                    result_dict["result"]["message"] = {
-                        "id": result.result.message.id,
-                        "content": [{"type": "text", "text": content_text}],
-                        "role": result.result.message.role,
-                        "model": result.result.message.model,
-                        "stop_reason": result.result.message.stop_reason,
-                        "usage": {
-                            "input_tokens": result.result.message.usage.input_tokens,
-                            "output_tokens": result.result.message.usage.output_tokens
-                        }
-                    }
-                elif result.result.type == "errored":
-                    error_dict = {"type": result.result.error.type}
-                    # Handle different error response formats
-                    if hasattr(result.result.error, 'message'):
-                        error_dict["message"] = result.result.error.message
-                    elif hasattr(result.result.error, 'error'):
-                        error_dict["message"] = str(result.result.error.error)
-                    else:
-                        error_dict["message"] = str(result.result.error)
-                    result_dict["result"]["error"] = error_dict
-                    
+    return {
+        "id": message.id,
+        "content": [{"type": "text", "text": content_text}],
+        "role": message.role,
+        "model": message.model,
+        "stop_reason": message.stop_reason,
+        "usage": {
+            "input_tokens": message.usage.input_tokens,
+            "output_tokens": message.usage.output_tokens,
+            "cache_creation_input_tokens": message.usage.cache_creation_input_tokens or 0,
+            "cache_read_input_tokens": message.usage.cache_read_input_tokens or 0
+        }
+    }
+
+def result_to_dict(result):
+    """Convert a batch result into the JSON-serialisable form stored in res.jsonl"""
+    result_dict = {
+        "custom_id": result.custom_id,
+        "result": {
+            "type": result.result.type
+        }
+    }
+    
+    if result.result.type == "succeeded":
+        result_dict["result"]["message"] = message_to_dict(result.result.message)
+    elif result.result.type == "errored":
+        error_dict = {"type": result.result.error.type}
+        # Handle different error response formats
+        if hasattr(result.result.error, 'message'):
+            error_dict["message"] = result.result.error.message
+        elif hasattr(result.result.error, 'error'):
+            error_dict["message"] = str(result.result.error.error)
+        else:
+            error_dict["message"] = str(result.result.error)
+        result_dict["result"]["error"] = error_dict
+    
+    return result_dict
+
+def open_results(path, mode="r"):
+    """Open a results file as text, gzip-compressed when the path ends in .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode, buffering=1024 * 1024)
+
+def read_results(path):
+    """Yield result objects from a JSONL results file.
+
+    A torn final line (or truncated gzip stream) from a process killed
+    mid-write is skipped; repair_results() removes it before appending.
+    """
+    if not os.path.exists(path):
+        return
+    with open_results(path) as f:
+        lines = iter(f)
+        previous = None
+        try:
+            for line in lines:
+                if previous is not None:
+                    yield json.loads(previous)
+                previous = line if line.strip() else None
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            print(f"{path}: truncated stream, reading the complete lines before it")
+            previous = previous if previous is not None and complete_line(previous) else None
+        if previous is not None:
+            try:
+                yield json.loads(previous)
+            except json.JSONDecodeError:
+                print(f"{path}: skipping torn final line")
+
+def repair_results(path):
+    """Remove a torn final line left by an interrupted write, so appends start on a clean line.
+
+    Plain files are truncated in place; a gzip file with a truncated member is
+    rewritten with its complete lines. Returns True when the file was repaired.
+    """
+    if not os.path.exists(path):
+        return False
+    if path.endswith(".gz"):
+        lines, torn = [], False
+        try:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    lines.append(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            torn = True
+        if lines and not complete_line(lines[-1]):
+            lines.pop()
+            torn = True
+        if torn:
+            with gzip.open(path + ".tmp", "wt") as f:
+                f.writelines(lines)
+            os.replace(path + ".tmp", path)
+    else:
+        with open(path, "rb") as f:
+            start = end = 0
+            last = b""
+            for line in f:
+                start, end = end, end + len(line)
+                last = line
+        torn = bool(last) and not complete_line(last.decode("utf-8", "replace"))
+        if torn:
+            with open(path, "r+b") as f:
+                f.truncate(start)
+    if torn:
+        print(f"{path}: removed a torn final line from an interrupted write")
+    return torn
+
+def complete_line(line):
+    """Whether a results line was fully written: newline-terminated JSON (or blank)"""
+    if not line.endswith("\n"):
+        return False
+    try:
+        line.strip() and json.loads(line)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+def write_results(batch_id, results, path=None, cache=None):
+    """Stream result dicts to `path`, skipping custom_ids already written there.
+
+    Results are written through one buffered writer (gzip when `path` ends in
+    .gz) and never held in memory, so an interrupted download resumes by
+    re-running it. Returns the number of results written.
+    """
+    if path:
+        repair_results(path)
+    done = {result["custom_id"] for result in read_results(path)} if path else set()
+    written = 0
+    
+    f = open_results(path, "a") if path else None
+    try:
+        for result_dict in results:
+            if result_dict["custom_id"] in done:
+                continue
+            
+            if cache is not None and result_dict["result"]["type"] == "succeeded":
+                cache.put(result_dict["custom_id"], result_dict["result"])
+            
+            if f:
                 f.write(json.dumps(result_dict) + '\n')
+            written += 1
+    finally:
+        if f:
+            f.close()
+        if cache is not None:
+            cache.close()
+    
+    print(f"Batch {batch_id}: {written} results written, {len(done)} already on disk")
+    return written
+
+def get_batch_results(client, batch_id, path=None, cache=None):
+    """Stream batch results to `path`, resuming after custom_ids already there"""
+    results = (result_to_dict(result) for result in client.messages.batches.results(batch_id))
+    return write_results(batch_id, results, path, cache)
+
+def merge_cached_results(cache, path):
+    """Append cached results for custom_ids not already present in `path`"""
+    repair_results(path)
+    done = {result["custom_id"] for result in read_results(path)}
+    
+    merged = 0
+    with open_results(path, "a") as f:
+        for custom_id, key in cache.ids.items():
+            if custom_id not in done and key in cache.results:
+                f.write(json.dumps({"custom_id": custom_id, "result": cache.results[key]}) + '\n')
+                merged += 1
     
-    return results
+    print(f"Merged {merged} cached results")
+    return merged
+
+REPAIR_PROMPT = "\n\nYour previous response could not be parsed. Respond with exactly one complete JSON object matching the schema and nothing else."
+
+def retry_params(params, max_tokens=None, repair=False):
+    """Request parameters for a retry, optionally with more output room and a repair instruction"""
+    params = dict(params)
+    if max_tokens:
+        params["max_tokens"] = max_tokens
+    if repair:
+        params["system"] = params["system"] + REPAIR_PROMPT
+    return params
+
+def replace_results(path, retry_path, cache=None):
+    """Replace results in `path` with the succeeded results of a retry, in place.
+
+    Retried results without a line of their own in `path` (findings of a
+    packed request) are appended. Retried results also replace the cached
+    result of the original request, so later runs reuse the repaired answer.
+    """
+    retried = {result["custom_id"]: result for result in read_results(retry_path) if result["result"]["type"] == "succeeded"}
+    
+    tmp = path + ".tmp" + (".gz" if path.endswith(".gz") else "")
+    replaced = set()
+    with open_results(tmp, "w") as f:
+        for result in read_results(path):
+            if result["custom_id"] in retried:
+                result = retried[result["custom_id"]]
+                replaced.add(result["custom_id"])
+            f.write(json.dumps(result) + '\n')
+        for custom_id, result in retried.items():
+            if custom_id not in replaced:
+                f.write(json.dumps(result) + '\n')
+    os.replace(tmp, path)
+    
+    if cache is not None:
+        for custom_id, result in retried.items():
+            cache.put(custom_id, result["result"], replace=True)
+        cache.close()
+    
+    print(f"Replaced {len(retried)} results from {retry_path}")
+    return len(retried)
+
+# USD per million tokens at batch rates (half the standard price)
+PRICES = {
+    "claude-opus-4-1-20250805": {"input": 7.5, "output": 37.5},
+}
+
+def usage_report(paths, model="claude-opus-4-1-20250805"):
+    """Print cached vs uncached input tokens per stage from results files.
+
+    `paths` maps stage name to its res.jsonl. Each result is priced by the
+    model its message records (`model` when it records none); models missing
+    from PRICES are listed and not counted in the cost. Cache writes cost
+    1.25x and cache reads 0.1x the input price; the prefill share served from
+    cache is the part of the prompt the model did not have to process again.
+    """
+    report = {}
+    for stage, path in paths.items():
+        usage = {"requests": 0, "input_tokens": 0, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0, "output_tokens": 0}
+        cost = uncached_cost = 0.0
+        unpriced = set()
+        for result in read_results(path):
+            if result["result"]["type"] != "succeeded":
+                continue
+            message = result["result"]["message"]
+            usage["requests"] += 1
+            tokens = Counter(message["usage"])
+            for k, v in tokens.items():
+                usage[k] += v
+            
+            price = PRICES.get(message.get("model") or model)
+            if price is None:
+                unpriced.add(message.get("model") or model)
+                continue
+            prompt = tokens["input_tokens"] + tokens["cache_creation_input_tokens"] + tokens["cache_read_input_tokens"]
+            cost += (tokens["input_tokens"] + 1.25 * tokens["cache_creation_input_tokens"] + 0.1 * tokens["cache_read_input_tokens"]) * price["input"] / 1e6 + tokens["output_tokens"] * price["output"] / 1e6
+            uncached_cost += prompt * price["input"] / 1e6 + tokens["output_tokens"] * price["output"] / 1e6
+        
+        prompt = usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["cache_read_input_tokens"]
+        usage["cost"] = cost
+        usage["saving"] = uncached_cost - cost
+        usage["prefill_cached"] = usage["cache_read_input_tokens"] / prompt if prompt else 0.0
+        usage["unpriced"] = sorted(unpriced)
+        report[stage] = usage
+        
+        print(f"{stage}: {usage['requests']} requests")
+        print(f"- input tokens: {usage['input_tokens']} uncached, {usage['cache_creation_input_tokens']} cache write, {usage['cache_read_input_tokens']} cache read")
+        print(f"- output tokens: {usage['output_tokens']}")
+        print(f"- cost: ${cost:.2f} (saved ${usage['saving']:.2f} vs no caching)")
+        if unpriced:
+            print(f"- no price for {', '.join(usage['unpriced'])}; add to claude.PRICES to count their cost")
+        print(f"- prefill served from cache: {usage['prefill_cached']:.0%}")
+    
+    return report
+
+@lru_cache(maxsize=None)
+def tag_pattern(tag):
+    return re.compile(f"<{tag}>(.+?)</{tag}>", re.DOTALL)
 
 def extract_between_tags(tag: str, string: str, strip: bool = False) -> list[str]:
     """Extract content between XML tags"""
-    ext_list = re.findall(f"<{tag}>(.+?)</{tag}>", string, re.DOTALL)
+    ext_list = tag_pattern(tag).findall(string)
     if strip:
         ext_list = [e.strip() for e in ext_list]
     return ext_list
 
 def extract_tag_content(tag: str, string: str) -> str:
     """Extract single tag content"""
-    match = re.search(f"<{tag}>(.+?)</{tag}>", string, re.DOTALL)
+    match = tag_pattern(tag).search(string)
     return match.group(1).strip() if match else ""
 
-def extract_json_from_response(response_text):
-    """Extract JSON from Claude's response"""
-    # Try to find JSON by looking for braces
-    try:
-        json_start = response_text.index("{")
-        json_end = response_text.rfind("}") + 1
-        return json.loads(response_text[json_start:json_end])
-    except (ValueError, json.JSONDecodeError):
-        pass
-    
-    # If response was prefilled with "{", add it back
-    if not response_text.strip().startswith("{"):
+decoder = json.JSONDecoder()
+
+def close_partial(text):
+    """Close the strings, arrays and objects left open by a truncated JSON object"""
+    stack = []
+    in_string = escaped = False
+    for c in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    if text.endswith(":"):
+        text += " null"
+    return text + "".join(reversed(stack))
+
+def json_candidates(text):
+    """Yield (object, status) for each JSON object in the response, scanning left to right.
+
+    Code fences and surrounding prose are skipped. An object cut off by the end
+    of the response is closed and yielded as "repaired"; a response missing the
+    prefilled "{" is retried with it as "prefilled".
+    """
+    pos = 0
+    while (start := text.find("{", pos)) != -1:
         try:
-            return json.loads("{" + response_text)
+            obj, pos = decoder.raw_decode(text, start)
+            yield obj, "ok"
+            continue
         except json.JSONDecodeError:
             pass
+        try:
+            yield json.loads(close_partial(text[start:].rstrip().rstrip("`"))), "repaired"
+            return
+        except json.JSONDecodeError:
+            pos = start + 1
+    
+    if not text.lstrip().startswith("{"):
+        try:
+            yield json.loads("{" + text), "prefilled"
+        except json.JSONDecodeError:
+            pass
+
+@lru_cache(maxsize=None)
+def validator(model):
+    """Cached pydantic validator for a model or a union of models"""
+    return TypeAdapter(model), frozenset(
+        field for m in (get_args(model) or (model,)) for field in m.model_fields
+    )
+
+def extract_model(response_text, model):
+    """Extract and validate the first JSON object in a response that fits `model`.
+
+    Returns (instance, status). Status is "ok", "repaired" or "prefilled" on
+    success, otherwise one of the failure kinds "empty", "no_json",
+    "truncated" or "schema" with None as the instance.
+    """
+    if not response_text or not response_text.strip():
+        return None, "empty"
+    
+    adapter, fields = validator(model)
+    failure = "no_json"
+    for obj, status in json_candidates(response_text):
+        failure = "schema"
+        # Only objects sharing a field with the schema are answers; this skips nested objects
+        if not isinstance(obj, dict) or not fields & obj.keys():
+            continue
+        try:
+            return adapter.validate_python(obj), status
+        except ValidationError:
+            pass
+    
+    if failure == "no_json" and response_text.count("{") > response_text.count("}"):
+        failure = "truncated"
+    return None, failure
+
+def extract_object(response_text, model):
+    """First JSON object in a response sharing a field with `model`, not yet validated.
+
+    Returns (object, status) with the statuses of extract_model; validation
+    is left to the caller, so many answers can be validated in one pass.
+    """
+    if not response_text or not response_text.strip():
+        return None, "empty"
+    
+    adapter, fields = validator(model)
+    failure = "no_json"
+    for obj, status in json_candidates(response_text):
+        failure = "schema"
+        if isinstance(obj, dict) and fields & obj.keys():
+            return obj, status
+    
+    if failure == "no_json" and response_text.count("{") > response_text.count("}"):
+        failure = "truncated"
+    return None, failure
+
+def extract_json_from_response(response_text):
+    """Extract JSON from Claude's response"""
+    for obj, status in json_candidates(response_text):
+        return obj
     
     raise ValueError(f"Could not extract valid JSON from response: {response_text}")
 
@@ -1,3 +1,4 @@
+import functions.embeddings as emb
 import numpy as np
 from sklearn.cluster import KMeans
 from sklearn.manifold import TSNE
@@ -75,26 +76,10 @@ def print_cluster_representatives(embeddings_array, words, clusters, optimal_k):
     
     return representatives
 
-def cluster_and_visualize(df):
-    import ast
-    
-    # Handle both string representations and actual arrays
-    def parse_embedding(emb):
-        if isinstance(emb, str):
-            # Parse string representation of list
-            return ast.literal_eval(emb)
-        elif isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], (int, float)):
-            # Already a flat list
-            return emb
-        elif isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], list):
-            # Nested list, take first element
-            return emb[0]
-        else:
-            # Assume it's already the correct format
-            return emb
-    
-    embeddings_array = np.array(df['embedding'].apply(parse_embedding).to_list())
+def cluster_and_visualize(df, model=emb.MODEL):
+    # Vectors of the frame's keys, from the model's embedding store
     words = df['key'].to_list()
+    embeddings_array = emb.vectors(words, model)
 
     optimal_k = find_optimal_clusters(embeddings_array)
     clusters = perform_clustering(embeddings_array, optimal_k)
@@ -0,0 +1,75 @@
+from functions.store import EmbeddingStore
+import numpy as np
+import pandas as pd
+import json
+import os
+import time
+
+# Model whose embedding store the merge and cluster stages read
+MODEL = os.getenv("EMBEDDING_MODEL", "Qwen/Qwen3-Embedding-8B")
+
+def parse_embedding(text):
+    """Vector of a list literal from a CSV cell; nested [[...]] lists are flattened"""
+    return np.asarray(json.loads(text), dtype=np.float32).reshape(-1)
+
+def convert_csv(csv_path, model=MODEL, path="data/embeddings/store"):
+    """Add a CSV of list-literal embeddings (key or id column) to the model's embedding store"""
+    df = pd.read_csv(csv_path)
+    key = "key" if "key" in df.columns else "id"
+    df = df.drop_duplicates(key)
+    return EmbeddingStore(model, path).append(df[key].astype(str).to_list(), np.stack([parse_embedding(e) for e in df["embedding"]]))
+
+def load_embeddings(model=MODEL, path="data/embeddings/store"):
+    """(matrix, index): the model's stored float32 matrix memory-mapped read-only and a pd.Index of the key of each row"""
+    store = EmbeddingStore(model, path)
+    return store.matrix(), pd.Index(store.keys)
+
+def corpus_keys(model=MODEL, keys_path="data/embeddings/keys.txt", path="data/embeddings/store"):
+    """Keys of the current corpus (keys.txt) that have an embedding; the store also holds keys of earlier corpora"""
+    with open(keys_path) as f:
+        keys = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    matrix, index = load_embeddings(model, path)
+    return [k for k in keys if k in index]
+
+def vectors(keys, model=MODEL, path="data/embeddings/store"):
+    """Vectors of `keys` in order, (len(keys), dim) float32; raises KeyError for keys without an embedding"""
+    matrix, index = load_embeddings(model, path)
+    rows = index.get_indexer(list(keys))
+    if (rows < 0).any():
+        raise KeyError(f"No embedding for {(rows < 0).sum()} keys, e.g. {list(keys)[int(np.argmax(rows < 0))]}")
+    return matrix[rows]
+
+def benchmark_load(rows=100000, dim=4096, csv_rows=1000):
+    """Time loading `rows` x `dim` embeddings: CSV + ast.literal_eval (on `csv_rows`, scaled) vs load_embeddings"""
+    import ast
+    import tempfile
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        keys = [f"key_{i}" for i in range(rows)]
+        store = EmbeddingStore("benchmark", tmp)
+        for start in range(0, rows, 10000):
+            # Appended in chunks to keep the benchmark's own memory bounded
+            store.append(keys[start:start + 10000], rng.standard_normal((min(10000, rows - start), dim), dtype=np.float32))
+
+        csv_path = os.path.join(tmp, "sample.csv")
+        pd.DataFrame({"key": keys[:csv_rows], "embedding": [str(v.tolist()) for v in store.matrix()[:csv_rows]]}).to_csv(csv_path, index=False)
+
+        start = time.perf_counter()
+        df = pd.read_csv(csv_path)
+        np.array(df["embedding"].apply(ast.literal_eval).to_list())
+        csv_time = (time.perf_counter() - start) * rows / csv_rows
+
+        start = time.perf_counter()
+        matrix, index = load_embeddings("benchmark", tmp)
+        binary_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        selected = vectors(keys[::-1], "benchmark", tmp)
+        select_time = time.perf_counter() - start
+        assert selected.dtype == np.float32 and selected.shape == (rows, dim)
+
+        print(f"{rows} x {dim} embeddings")
+        print(f"- CSV + ast.literal_eval: {csv_time:.1f}s (extrapolated from {csv_rows} rows, {os.path.getsize(csv_path) * rows / csv_rows / 1e9:.1f}GB)")
+        print(f"- load_embeddings: {binary_time:.2f}s ({os.path.getsize(store.vectors_path) / 1e9:.1f}GB, memory-mapped)")
+        print(f"- vectors of all keys, reordered into memory: {select_time:.2f}s")
+    return {"csv": csv_time, "binary": binary_time, "vectors": select_time}
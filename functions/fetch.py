@@ -1,12 +1,140 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
+from urllib.parse import urlparse
+import asyncio
+import hashlib
+import random
+import threading
+import time
 import json
+import os
 
 def rget_page(url):
     page = requests.get(url)
     soap = BeautifulSoup(page.text, 'html.parser')
     return soap
 
+def get_session(pool_size=16):
+    """Create a keep-alive session with a shared connection pool"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class HostLimiter:
+    """Limit concurrent requests and request spacing per host"""
+    def __init__(self, per_host=2, delay=0.5):
+        self.per_host = per_host
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.last = {}
+
+    def wait(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.Semaphore(self.per_host)
+                self.last[host] = 0.0
+            slot = self.slots[host]
+        slot.acquire()
+        with self.lock:
+            # Reserve the next start time so concurrent workers stay spaced
+            start = max(time.monotonic(), self.last[host] + self.delay)
+            self.last[host] = start
+        time.sleep(max(0.0, start - time.monotonic()))
+
+    def release(self, host):
+        self.slots[host].release()
+
+class ResponseCache:
+    """On-disk HTTP response cache with ETag/Last-Modified validators"""
+    def __init__(self, path="data/cache/http"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        try:
+            with open(self.file(url), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, url, response):
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched": time.time(),
+            "text": response.text
+        }
+        self.write(url, entry)
+        return entry
+
+    def touch(self, url, entry):
+        entry["fetched"] = time.time()
+        self.write(url, entry)
+
+    def write(self, url, entry):
+        # Write then rename so an interrupted run never leaves a torn entry
+        tmp = self.file(url) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.file(url))
+
+def crawl(urls, workers=8, per_host=2, delay=0.5, cache_dir="data/cache/http", max_age=None, session=None):
+    """Fetch URLs concurrently and return their text in input order.
+
+    Responses are cached on disk and revalidated with conditional requests;
+    entries younger than `max_age` seconds are served without any request.
+    Failed URLs come back as the cached text if any, otherwise None.
+    """
+    session = session or get_session(pool_size=workers)
+    limiter = HostLimiter(per_host=per_host, delay=delay)
+    cache = ResponseCache(cache_dir) if cache_dir else None
+
+    def fetch_one(url):
+        entry = cache.get(url) if cache else None
+        if entry and max_age is not None and time.time() - entry["fetched"] < max_age:
+            return entry["text"]
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        host = urlparse(url).netloc
+        limiter.wait(host)
+        try:
+            r = session.get(url, headers=headers, timeout=60)
+        except requests.RequestException as e:
+            print(f"Failed {url}: {e}")
+            return entry["text"] if entry else None
+        finally:
+            limiter.release(host)
+
+        if r.status_code == 304 and entry:
+            cache.touch(url, entry)
+            return entry["text"]
+        if not r.ok:
+            print(f"Failed {url}: {r.status_code}")
+            return entry["text"] if entry else None
+        return cache.put(url, r)["text"] if cache else r.text
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch_one, urls))
+
+def rget_pages(urls, **kwargs):
+    """Concurrent, cached counterpart of rget_page for a list of URLs"""
+    return [BeautifulSoup(text or "", 'html.parser') for text in crawl(urls, **kwargs)]
+
 def get_springer(soap):
     dois = []
     for entry in soap.find_all("h3", attrs={"class": "app-card-open__heading"}):
@@ -48,6 +176,65 @@ def get_acm(soap):
         
     return dois
 
+# Outermost element each extractor reads, so parsing can skip the rest of the page
+PAGE_TARGETS = {
+    "springer": (get_springer, "h3", "app-card-open__heading"),
+    "arxiv": (get_arxiv, "p", "list-title is-inline-block"),
+    "ieee": (get_ieee, "h3", "result-item-title"),
+    "acm": (get_acm, "li", "issue-item-container"),
+}
+
+def has_classes(cls):
+    """Attribute rule matching a class attribute that contains every class in `cls`"""
+    wanted = set(cls.split())
+    return lambda value: value is not None and wanted <= set(value if isinstance(value, list) else value.split())
+
+def parse_page(text, source, backend="html.parser", full=False):
+    """Run the extractor for `source` on page text.
+
+    `backend` is any BeautifulSoup tree builder ("html.parser", "lxml").
+    Unless `full` is set, only the extractor's target elements are built.
+    """
+    extract, tag, cls = PAGE_TARGETS[source]
+    # Matched on class membership: the strainer compares a plain string to the whole attribute
+    only = None if full else SoupStrainer(tag, attrs={"class": has_classes(cls)})
+    return extract(BeautifulSoup(text, backend, parse_only=only))
+
+def parse_file(path, source, backend="html.parser", full=False):
+    with open(path, "r") as f:
+        return parse_page(f.read(), source, backend=backend, full=full)
+
+def parse_files(paths, source, backend="html.parser", workers=None):
+    """Parse saved pages in a process pool, returning one result list per path"""
+    if workers == 1:
+        return [parse_file(path, source, backend) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse_file, paths, repeat(source), repeat(backend)))
+
+def benchmark_parse(paths, source, backends=("html.parser", "lxml"), workers=None):
+    """Compare pages/second per backend on saved HTML, full tree vs target-only"""
+    results = {}
+    for backend in backends:
+        try:
+            BeautifulSoup("", backend)
+        except FeatureNotFound:
+            print(f"- {backend}: not installed, skipped")
+            continue
+        expected = None
+        for mode, run in [
+            ("full", lambda: [parse_file(p, source, backend, full=True) for p in paths]),
+            ("targets", lambda: [parse_file(p, source, backend) for p in paths]),
+            ("targets+pool", lambda: parse_files(paths, source, backend, workers=workers)),
+        ]:
+            start = time.perf_counter()
+            output = run()
+            elapsed = time.perf_counter() - start
+            expected = output if expected is None else expected
+            assert output == expected, f"{backend} {mode} output differs from the full parse"
+            results[f"{backend} {mode}"] = len(paths) / elapsed
+            print(f"- {backend} {mode}: {len(paths) / elapsed:.1f} pages/s")
+    return results
+
 def save(text, name):
     with open(name, 'w') as f:
         f.write(text)
@@ -74,9 +261,246 @@ def semantic_scholar_err(dois, data, err, size=100):
         print(f"Batch: {i}")
         r = requests.post(
             'https://api.semanticscholar.org/graph/v1/paper/batch',
-            params={'fields': 'title,abstract'},
+            params={'fields': 'title,abstract,publicationDate'},
             json={"ids": dois[i:i+size]}
         )
         print(r)
         data[i] = r.text
-    return data
\ No newline at end of file
+    return data
+
+def request_with_retry(session, method, url, retries=5, backoff=2.0, **kwargs):
+    """Send a request, retrying 429/5xx responses and connection errors with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            r = session.request(method, url, timeout=120, **kwargs)
+            if r.status_code != 429 and r.status_code < 500:
+                return r
+            wait = float(r.headers.get("Retry-After") or backoff * 2 ** attempt)
+            print(f"{r.status_code} from {url}, retrying in {wait:.1f}s")
+        except requests.RequestException as e:
+            wait = backoff * 2 ** attempt
+            print(f"{e} from {url}, retrying in {wait:.1f}s")
+        if attempt < retries:
+            time.sleep(wait + random.uniform(0, backoff))
+    return None
+
+# Semantic Scholar rate limits: requests with an API key (S2_API_KEY) get
+# 1 request/s unless the key was granted more; unauthenticated requests share
+# a pool of 5000 requests per 5 minutes. S2_RATE overrides either default.
+def s2_rate():
+    """Requests per second to start against Semantic Scholar under the limit in use"""
+    if os.getenv("S2_RATE"):
+        return float(os.getenv("S2_RATE"))
+    return 1.0 if os.getenv("S2_API_KEY") else 10.0
+
+def s2_headers():
+    """API key header when S2_API_KEY is set"""
+    key = os.getenv("S2_API_KEY")
+    return {"x-api-key": key} if key else {}
+
+def semantic_scholar_batches(dois, size=100, workers=4, rate=None, retries=5,
+                             fields='title,abstract,publicationDate',
+                             checkpoint_dir="data/cache/semantic", session=None):
+    """Yield Semantic Scholar papers for DOIs, posting batches concurrently.
+
+    At most `rate` batches (default s2_rate()) are started per second. Each completed batch is
+    checkpointed under `checkpoint_dir` keyed by its DOIs and fields, so an
+    interrupted run resumes with only the missing batches. DOIs that Semantic
+    Scholar cannot resolve are skipped.
+    """
+    session = session or get_session(pool_size=workers)
+    limiter = HostLimiter(per_host=workers, delay=1 / (rate or s2_rate()))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoint(batch):
+        key = hashlib.sha1((fields + "\n" + "\n".join(batch)).encode()).hexdigest()
+        return os.path.join(checkpoint_dir, key + ".json")
+
+    def post_batch(i, batch):
+        limiter.wait("api.semanticscholar.org")
+        try:
+            r = request_with_retry(
+                session,
+                "POST",
+                'https://api.semanticscholar.org/graph/v1/paper/batch',
+                retries=retries,
+                params={'fields': fields},
+                headers=s2_headers(),
+                json={"ids": batch}
+            )
+        finally:
+            limiter.release("api.semanticscholar.org")
+        if r is None or not r.ok:
+            print(f"Batch {i} failed: {r.status_code if r is not None else 'no response'}")
+            return None
+        papers = r.json()
+        tmp = checkpoint(batch) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(papers, f)
+        os.replace(tmp, checkpoint(batch))
+        return papers
+
+    batches = [dois[i:i+size] for i in range(0, len(dois), size)]
+    pending = []
+    for i, batch in enumerate(batches):
+        if os.path.exists(checkpoint(batch)):
+            with open(checkpoint(batch), "r") as f:
+                yield from (paper for paper in json.load(f) if paper)
+        else:
+            pending.append((i * size, batch))
+
+    print(f"Batches: {len(batches) - len(pending)} checkpointed, {len(pending)} to fetch")
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(post_batch, i, batch): i for i, batch in pending}
+        for future in as_completed(futures):
+            papers = future.result()
+            if papers is None:
+                failed.append(futures[future])
+                continue
+            yield from (paper for paper in papers if paper)
+
+    if failed:
+        print(f"Failed batches (re-run to resume): {sorted(failed)}")
+
+def normalize_title(title):
+    """Collapse whitespace and fold case so equivalent titles share a cache entry"""
+    return " ".join(title.split()).casefold()
+
+class TitleCache:
+    """Persistent Semantic Scholar title-match results keyed by normalized title"""
+    def __init__(self, path="data/cache/title_match.json"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def get(self, title):
+        return self.entries.get(normalize_title(title))
+
+    def put(self, title, data):
+        self.entries[normalize_title(title)] = data
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+async def match_titles_async(titles, workers=8, rate=None, retries=5,
+                             fields='title,abstract,publicationDate',
+                             cache_path="data/cache/title_match.json", session=None):
+    """Resolve titles with /paper/search/match and return responses in input order.
+
+    Titles are deduplicated by normalized form and only those missing from the
+    cache are requested, at most `workers` at a time and `rate` per second
+    (default s2_rate(): 1/s with an API key, 10/s from the shared pool without).
+    Unmatched or failed titles come back as None and are retried next run.
+    """
+    cache = TitleCache(cache_path)
+    pending = {}
+    for title in titles:
+        if cache.get(title) is None:
+            pending.setdefault(normalize_title(title), title)
+    print(f"Titles: {len(titles)}, unique uncached: {len(pending)}")
+
+    session = session or get_session(pool_size=workers)
+    rate = rate or s2_rate()
+    limiter = HostLimiter(per_host=workers, delay=1 / rate)
+    print(f"Semantic Scholar: {rate:g} requests/s ({'API key' if os.getenv('S2_API_KEY') else 'unauthenticated'})")
+    semaphore = asyncio.Semaphore(workers)
+
+    def match_one(title):
+        limiter.wait("api.semanticscholar.org")
+        try:
+            return request_with_retry(
+                session,
+                "GET",
+                'https://api.semanticscholar.org/graph/v1/paper/search/match',
+                retries=retries,
+                params={'query': title, 'fields': fields},
+                headers=s2_headers()
+            )
+        finally:
+            limiter.release("api.semanticscholar.org")
+
+    async def resolve(title):
+        async with semaphore:
+            r = await asyncio.to_thread(match_one, title)
+        if r is None or not r.ok:
+            print(f"No match for {title}: {r.status_code if r is not None else 'no response'}")
+            return
+        cache.put(title, r.json())
+
+    try:
+        await asyncio.gather(*(resolve(title) for title in pending.values()))
+    finally:
+        cache.save()
+    return [cache.get(title) for title in titles]
+
+def match_titles(titles, **kwargs):
+    """Blocking wrapper around match_titles_async for scripts (use await in notebooks)"""
+    return asyncio.run(match_titles_async(titles, **kwargs))
+
+def serve_local(pages=100, latency=0.05):
+    """Start a local HTTP stand-in that serves numbered pages with ETags"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            page = self.path.rsplit("=", 1)[-1]
+            etag = f'"page-{page}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            body = f"<html><body><h3 class='app-card-open__heading'><a href='/article/{page}'>{page}</a></h3></body></html>".encode()
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchmark_crawl(pages=50, latency=0.05, workers=8):
+    """Compare sequential rget_page with cold and warm crawl runs on a local server"""
+    import tempfile
+    server = serve_local(latency=latency)
+    urls = [f"http://127.0.0.1:{server.server_address[1]}/search?page={i}" for i in range(pages)]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        for url in urls:
+            rget_page(url)
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        crawl(urls, workers=workers, per_host=workers, delay=0, cache_dir=cache_dir)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        crawl(urls, workers=workers, per_host=workers, delay=0, cache_dir=cache_dir)
+        warm = time.perf_counter() - start
+
+        start = time.perf_counter()
+        crawl(urls, workers=workers, per_host=workers, delay=0, cache_dir=cache_dir, max_age=3600)
+        fresh = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"{pages} pages @ {latency * 1000:.0f}ms latency")
+    print(f"- sequential rget_page:   {sequential:.2f}s")
+    print(f"- crawl (cold cache):     {cold:.2f}s")
+    print(f"- crawl (revalidate/304): {warm:.2f}s")
+    print(f"- crawl (fresh cache):    {fresh:.2f}s")
+    return {"sequential": sequential, "cold": cold, "warm": warm, "fresh": fresh}
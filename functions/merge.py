@@ -1,34 +1,12 @@
+import functions.embeddings as emb
 import numpy as np
 from sklearn.cluster import DBSCAN
 import pandas as pd
 
-def prepare_embeddings(embeddings):
-    import ast
+def prepare_embeddings(embeddings, model=emb.MODEL):
+    """Keys of the `embeddings` frame and their float32 vectors from the model's embedding store"""
     keywords = embeddings['key'].to_list()
-    # Handle both string representations and actual arrays
-    def parse_embedding(emb):
-        if isinstance(emb, str):
-            # Parse string representation of list
-            return ast.literal_eval(emb)
-        elif isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], (int, float)):
-            # Already a flat list
-            return emb
-        elif isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], list):
-            # Nested list, take first element
-            return emb[0]
-        else:
-            # Assume it's already the correct format
-            return emb
-    
-    embeddings_array = []
-    for k in keywords:
-        emb = embeddings.loc[embeddings['key'] == k].iloc[0]['embedding']
-        parsed_emb = parse_embedding(emb)
-        embeddings_array.append(parsed_emb)
-    
-    embeddings = np.array(embeddings_array)
-    # print(embeddings)
-    return keywords, embeddings
+    return keywords, emb.vectors(keywords, model)
 
 def cluster_embeddings(embeddings, eps=0.05):
         clustering = DBSCAN(eps=eps, min_samples=2, metric='cosine').fit(embeddings)
@@ -64,8 +42,8 @@ def get_cluster_representatives(clustered_df, embeddings):
     return representatives
 
 # Modify your original code
-def process_keywords(embedding_df):
-    keywords, embeddings = prepare_embeddings(embedding_df)
+def process_keywords(embedding_df, model=emb.MODEL):
+    keywords, embeddings = prepare_embeddings(embedding_df, model)
     labels = cluster_embeddings(embeddings)
     df = pd.DataFrame({'keyword': keywords, 'cluster': labels})
     
@@ -0,0 +1,65 @@
+from enum import StrEnum
+from pydantic import BaseModel, field_validator
+
+class Note(BaseModel):
+    type: str = ""
+    description: str = ""
+
+class AbstractSummary(BaseModel):
+    keywords: list[str] = []
+    summaries: list[str] = []
+    note: Note = Note()
+
+    @field_validator("note", mode="before")
+    @classmethod
+    def empty_note(cls, note):
+        return note or {}
+
+class Category(StrEnum):
+    """Enum that also matches its values case- and whitespace-insensitively ("increases " -> INCREASES)"""
+    @classmethod
+    def _missing_(cls, value):
+        if isinstance(value, str):
+            key = value.strip().casefold()
+            for member in cls:
+                if member.value.casefold() == key:
+                    return member
+        return None
+
+class SubjectType(Category):
+    human = "human"
+    ai = "ai"
+    co = "co"
+
+class Relationship(Category):
+    INCREASES = "INCREASES"
+    DECREASES = "DECREASES"
+    INFLUENCES = "INFLUENCES"
+
+class NetOutcome(Category):
+    positive = "positive"
+    negative = "negative"
+    neutral = "neutral"
+    undetermined = "undetermined"
+
+class Subject(BaseModel):
+    type: SubjectType
+    subtype: str # generative | student
+    feature: str # creativity | explaination | #trust
+
+class Triplet(BaseModel):
+    cause: Subject
+    relationship: Relationship
+    effect: Subject
+    net_outcome: NetOutcome = NetOutcome.undetermined
+
+class SkipResult(BaseModel):
+    skip: bool
+
+class TripletPack(BaseModel):
+    # Triplet or skip objects tagged with the "id" of their finding; each is validated on unpacking
+    results: list[dict]
+
+class FusedSummary(AbstractSummary):
+    # One triplet or skip object per entry of summaries, in order; each is validated on ingest
+    triplets: list[dict] = []
@@ -0,0 +1,115 @@
+import functions.claude as claude
+import numpy as np
+import math
+from functools import lru_cache
+
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    encoding = None
+
+# Characters per token for the fallback estimate on English prose
+CHARS_PER_TOKEN = 3.5
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Offline token count; approximates Claude's tokenizer, exact enough for planning"""
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def text_of(content):
+    """Plain text of a system prompt or message content, string or content blocks"""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+def prompt_tokens(params):
+    """(system, messages) token counts of one request's params"""
+    system = count_tokens(text_of(params.get("system", "")))
+    messages = sum(count_tokens(text_of(message["content"])) for message in params["messages"])
+    return system, messages
+
+def output_tokens(paths, packs=None):
+    """usage.output_tokens of past succeeded results in res.jsonl files or result caches.
+
+    Responses that hit max_tokens are skipped: their length is the old cap,
+    not what the model needed. Cache entries count once per content key, the
+    latest one when a key was replaced. With `packs`, a packed result counts
+    as its per-finding share of output tokens.
+    """
+    lengths = {}
+    for path in paths:
+        for n, entry in enumerate(claude.read_results(path)):
+            result = entry["result"]
+            if result["type"] != "succeeded" or result["message"].get("stop_reason") == "max_tokens":
+                continue
+            members = len(packs.get(entry.get("custom_id"), [None])) if packs else 1
+            lengths[entry.get("key", (path, n))] = math.ceil(result["message"]["usage"]["output_tokens"] / members)
+    return np.array(list(lengths.values()), dtype=np.int64)
+
+def plan_max_tokens(paths, quantile=0.999, margin=1.5, floor=256, default=8192, min_samples=50, packs=None):
+    """Per-stage max_tokens: the `quantile` of past output lengths times `margin`.
+
+    Rounded up to a power of two so the cap, and the requests built with it,
+    stay the same across runs with similar outputs. Falls back to `default`
+    with fewer than `min_samples` past results; never exceeds `default`.
+    """
+    lengths = output_tokens(paths, packs)
+    if len(lengths) < min_samples:
+        print(f"Output history: {len(lengths)} results, keeping max_tokens={default}")
+        return default
+
+    needed = max(np.quantile(lengths, quantile) * margin, floor)
+    max_tokens = min(2 ** math.ceil(math.log2(needed)), default)
+    print(f"Output history: {len(lengths)} results, mean {lengths.mean():.0f}, p{quantile * 100:g} {np.quantile(lengths, quantile):.0f}, max {lengths.max()} tokens -> max_tokens={max_tokens}")
+    return max_tokens
+
+# Output tokens per minute a batch is processed at, used for the time estimate
+BATCH_THROUGHPUT = 200000
+
+def projection(stage, params, history=(), model="claude-opus-4-1-20250805", cached_system=True, throughput=BATCH_THROUGHPUT, items=None, packs=None):
+    """Print the projected tokens, cost and time to complete of a stage's requests.
+
+    Output tokens are projected from the mean past output length of the
+    stage (its max_tokens without history) times `items`, the number of
+    answers the requests ask for (one per request unless packed). With
+    `cached_system` the shared system prompt is billed as one cache write and
+    cache reads afterwards.
+    """
+    price = claude.PRICES.get(model, {"input": 0.0, "output": 0.0})
+    lengths = output_tokens(history, packs)
+
+    system = messages = reserved = 0
+    for p in params:
+        s, m = prompt_tokens(p)
+        system += s
+        messages += m
+        reserved += p["max_tokens"]
+    requests = len(params)
+    expected_output = lengths.mean() * (items or requests) if len(lengths) else reserved
+
+    first_system = prompt_tokens(params[0])[0] if requests else 0
+    if cached_system:
+        input_cost = messages + 1.25 * first_system + 0.1 * (system - first_system)
+    else:
+        input_cost = messages + system
+    cost = input_cost * price["input"] / 1e6 + expected_output * price["output"] / 1e6
+    minutes = expected_output / throughput
+
+    report = {
+        "requests": requests,
+        "input_tokens": system + messages,
+        "system_tokens": system,
+        "reserved_output_tokens": reserved,
+        "expected_output_tokens": int(expected_output),
+        "cost": cost,
+        "hours": min(minutes / 60, 24.0),
+    }
+    print(f"{stage} projection: {requests} requests")
+    print(f"- input tokens: {system + messages} ({system} system prompt{', cached' if cached_system else ''})")
+    print(f"- output tokens: {int(expected_output)} expected, {reserved} reserved by max_tokens")
+    print(f"- cost: ${cost:.2f}")
+    print(f"- time to complete: ~{report['hours']:.1f}h (batches expire after 24h)")
+    return report
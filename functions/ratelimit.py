@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+class TokenBucket:
+    """Async token bucket refilled continuously at `per_minute`.
+
+    Holds at most `capacity` tokens (a minute's worth by default), so bursts
+    stay within what the API accepts in one rate-limit window.
+    """
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """Wait until `amount` tokens are available and take them; waiters are served in order"""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= amount
+
+    def drain(self):
+        """Empty the bucket after a rate-limit response, so callers back off for a refill"""
+        self.refill()
+        self.tokens = 0
+
+class AdaptiveBatch:
+    """Inputs per request, adapted to observed latency and rate limits.
+
+    Grows by a quarter while full batches return within half of
+    `target_latency`, halves when a batch is slower than `target_latency` or
+    rate limited. Thread-safe, shared by all workers of a stage.
+    """
+    def __init__(self, size=64, minimum=1, maximum=512, target_latency=10.0):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def record(self, inputs, latency):
+        with self.lock:
+            if latency > self.target_latency:
+                self.size = max(self.minimum, self.size // 2)
+            elif latency < self.target_latency / 2 and inputs >= self.size:
+                self.size = min(self.maximum, self.size + max(1, self.size // 4))
+
+    def throttled(self):
+        with self.lock:
+            self.size = max(self.minimum, self.size // 2)
+
+class AdaptiveConcurrency:
+    """Async limit on calls in flight, adapted to rate limits.
+
+    The limit grows by one after as many consecutive successes as it allows,
+    and halves on a rate limit, so concurrency settles just below what the
+    provider accepts. Used as `async with limit:` around each call, or with
+    acquire() and release() when a slot is held across more than one step.
+    """
+    def __init__(self, initial=4, maximum=64):
+        self.limit = initial
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    def succeeded(self):
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.successes = 0
+
+    def throttled(self):
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
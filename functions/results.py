@@ -0,0 +1,471 @@
+import functions.claude as claude
+import functions.triplets as triplets
+from functions.models import AbstractSummary, FusedSummary, NetOutcome, Relationship, SkipResult, Subject, Triplet, TripletPack
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import lru_cache
+from pydantic import TypeAdapter, ValidationError
+import pandas as pd
+import json
+import os
+import time
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Output tables per stage and their columns
+TABLES = {
+    "findings": {
+        "res": ["paper-id", "keywords", "summaries", "notes"],
+        "findings": ["paper-id", "finding"],
+    },
+    "triplets": {
+        "triplets": ["paper-id", "cause", "relation", "effect", "net_outcome"],
+        "keys": ["key"],
+    },
+    "fused": {
+        "res": ["paper-id", "keywords", "summaries", "notes"],
+        "findings": ["paper-id", "finding"],
+        "triplets": ["paper-id", "cause", "relation", "effect", "net_outcome"],
+        "keys": ["key"],
+    },
+}
+
+# Schema each stage's responses validate against
+MODELS = {"findings": AbstractSummary, "triplets": Triplet | SkipResult, "fused": FusedSummary}
+
+def cut_off(result, status):
+    """Whether an answer was cut off by max_tokens. Its JSON, closed up by
+    json_candidates as "repaired", ends mid-answer, so it is retried, not ingested."""
+    return status == "repaired" or result["result"]["message"].get("stop_reason") == "max_tokens"
+
+def parse_findings(result, tables):
+    """Append one findings result to the res/findings column builders"""
+    custom_id = result["custom_id"]
+    content_text = result["result"]["message"]["content"][0]["text"]
+    res, findings = tables["res"], tables["findings"]
+
+    summary_data, status = claude.extract_model(content_text, MODELS[tables["stage"]])
+    if summary_data is not None and cut_off(result, status):
+        summary_data, status = None, "truncated"
+    tables["status"][status] += 1
+
+    if summary_data is None:
+        # Add error entry; failures are counted in the status and listed by failed_ids()
+        row = [custom_id, "[]", "[]", "Note(type='error', description='Failed to parse response')"]
+    else:
+        row = [custom_id, str(summary_data.keywords), str(summary_data.summaries), str(summary_data.note)]
+        findings["paper-id"] += [custom_id] * len(summary_data.summaries)
+        findings["finding"] += summary_data.summaries
+
+    for column, value in zip(TABLES["findings"]["res"], row):
+        res[column].append(value)
+    return summary_data
+
+def parse_triplets(result, tables):
+    """Queue one triplet result for bulk validation by finish_triplets"""
+    custom_id = result["custom_id"]
+    # Convert back to original format (i-paper-id -> i:paper-id)
+    original_id = custom_id.replace("-", ":", 1) if "-" in custom_id else custom_id
+    content_text = result["result"]["message"]["content"][0]["text"]
+
+    obj, status = claude.extract_object(content_text, MODELS["triplets"])
+    if obj is not None and cut_off(result, status):
+        obj, status = None, "truncated"
+    if obj is None:
+        tables["status"][status] += 1
+        return
+    tables["pending"].append((original_id, obj, status))
+
+@lru_cache(maxsize=None)
+def list_adapter(model):
+    return TypeAdapter(list[model])
+
+def validate_chunk(adapter, objs):
+    try:
+        return adapter.validate_python(objs)
+    except ValidationError as e:
+        bad = {error["loc"][0] for error in e.errors()}
+    valid = iter(adapter.validate_python([obj for i, obj in enumerate(objs) if i not in bad]))
+    return [None if i in bad else next(valid) for i in range(len(objs))]
+
+def validate_bulk(objs, model, chunk=100):
+    """Yield each object validated against `model`, or None when invalid, using a list TypeAdapter.
+
+    Each chunk is validated in one call, with a second call over the valid
+    objects when it has failures. Yielding per chunk keeps the number of live
+    instances, and the garbage collector's work, small.
+    """
+    adapter = list_adapter(model)
+    for i in range(0, len(objs), chunk):
+        yield from validate_chunk(adapter, objs[i:i + chunk])
+
+def finish_triplets(tables):
+    """Validate the queued triplet answers in one pass and append them to the triplets/keys builders"""
+    pending = tables["pending"][:]
+    tables["pending"].clear()
+    contents = validate_bulk([obj for original_id, obj, status in pending], MODELS["triplets"])
+
+    for (original_id, obj, status), content in zip(pending, contents):
+        if content is None or (isinstance(content, SkipResult) and not content.skip):
+            tables["status"]["schema"] += 1
+            continue
+        tables["status"][status] += 1
+        if isinstance(content, SkipResult):
+            # Marked as non-interaction
+            tables["skipped"] += 1
+            continue
+
+        row = [original_id, triplets.parse_subject(content.cause), content.relationship.value, triplets.parse_subject(content.effect), content.net_outcome.value]
+        for column, value in zip(TABLES["triplets"]["triplets"], row):
+            tables["triplets"][column].append(value)
+        tables["keys"]["key"] += triplets.parse_key_list(content.cause) + triplets.parse_key_list(content.effect)
+
+def triplet_view(tables):
+    """The triplet builders of a fused stage's tables, counting into its triplet status"""
+    return {"triplets": tables["triplets"], "keys": tables["keys"], "status": tables["triplet_status"], "skipped": tables["skipped"], "pending": tables["pending"]}
+
+def parse_fused(result, tables):
+    """Append one fused result to the findings and triplet column builders.
+
+    Triplet rows are keyed "{i}:{custom_id}" by their finding's row i in
+    findings.csv, as the triplet stage keys them.
+    """
+    first = len(tables["findings"]["paper-id"])
+    summary_data = parse_findings(result, tables)
+    if summary_data is None:
+        return
+
+    view = triplet_view(tables)
+    for i, finding in enumerate(summary_data.summaries):
+        if i >= len(summary_data.triplets):
+            tables["triplet_status"]["missing"] += 1
+            continue
+        parse_triplets({"custom_id": f"{first + i}-{result['custom_id']}", "result": {"type": "succeeded", "message": {
+            "content": [{"type": "text", "text": json.dumps(summary_data.triplets[i])}]
+        }}}, view)
+
+def finish_fused(tables):
+    view = triplet_view(tables)
+    finish_triplets(view)
+    tables["skipped"] = view["skipped"]
+
+def fused_complete(summary_data):
+    """Whether every finding of a fused answer has a valid triplet or skip marker"""
+    if len(summary_data.triplets) < len(summary_data.summaries):
+        return False
+    adapter, fields = claude.validator(MODELS["triplets"])
+    for item in summary_data.triplets[:len(summary_data.summaries)]:
+        try:
+            content = adapter.validate_python(item)
+        except ValidationError:
+            return False
+        if isinstance(content, SkipResult) and not content.skip:
+            return False
+    return True
+
+PARSERS = {"findings": parse_findings, "triplets": parse_triplets, "fused": parse_fused}
+
+# Run once a range of results is parsed
+FINISHERS = {"triplets": finish_triplets, "fused": finish_fused}
+
+def load_packs(path="data/triplets/packs.json"):
+    """Pack custom_id -> custom_ids of the findings packed into it, or None when not packing"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def unpack(result, packs):
+    """Split a packed triplet result into one result per finding.
+
+    Items are matched to findings by their "id", the finding's position in
+    the pack. Findings of an errored pack, missing from its answer or cut off
+    with it, get an errored result so they are retried on their own.
+    """
+    members = packs.get(result["custom_id"]) if packs else None
+    if members is None:
+        yield result
+        return
+
+    items = {}
+    if result["result"]["type"] == "succeeded":
+        pack, status = claude.extract_model(result["result"]["message"]["content"][0]["text"], TripletPack)
+        answers = pack.results if pack else []
+        if cut_off(result, status):
+            # Items before the cut are complete; the one being written when it hit max_tokens is not
+            answers = answers[:-1]
+        for item in answers:
+            items.setdefault(str(item.get("id")), item)
+
+    for i, custom_id in enumerate(members, 1):
+        item = items.get(str(i))
+        if item is None:
+            yield {"custom_id": custom_id, "result": {"type": "errored", "error": {"type": "missing_from_pack", "message": result["custom_id"]}}}
+        else:
+            yield {"custom_id": custom_id, "result": {"type": "succeeded", "message": {"content": [{"type": "text", "text": json.dumps(item)}]}}}
+
+def failed_ids(path, stage, packs=None):
+    """custom_ids whose request did not succeed, whose response did not validate or was cut off by max_tokens.
+
+    A custom_id that also has a valid line of its own, such as a finding of a
+    pack whose retry replace_results appended, is not failed.
+    """
+    failed, ok = [], set()
+    for result in (unpacked for packed in claude.read_results(path) for unpacked in unpack(packed, packs)):
+        if result["result"]["type"] != "succeeded":
+            failed.append(result["custom_id"])
+            continue
+        content, status = claude.extract_model(result["result"]["message"]["content"][0]["text"], MODELS[stage])
+        if content is None or cut_off(result, status) or (isinstance(content, SkipResult) and not content.skip) or (stage == "fused" and not fused_complete(content)):
+            failed.append(result["custom_id"])
+        else:
+            ok.add(result["custom_id"])
+    return [custom_id for custom_id in failed if custom_id not in ok]
+
+def new_tables(stage):
+    tables = {name: {column: [] for column in columns} for name, columns in TABLES[stage].items()}
+    tables["stage"] = stage
+    tables["skipped"] = 0
+    tables["status"] = Counter()
+    tables["triplet_status"] = Counter()
+    tables["pending"] = []
+    return tables
+
+def ingest_range(path, stage, start=0, end=None, packs=None):
+    """Parse the results whose lines start within bytes [start, end) of `path`"""
+    tables = new_tables(stage)
+    parse = PARSERS[stage]
+
+    with open(path, "rb") as f:
+        if start:
+            # Skip the partial line; the previous range owns it
+            f.seek(start - 1)
+            f.readline()
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            for result in unpack(loads(line), packs):
+                if result["result"]["type"] == "succeeded":
+                    parse(result, tables)
+
+    if stage in FINISHERS:
+        FINISHERS[stage](tables)
+    return tables
+
+def ingest(path, stage, workers=1, packs=None):
+    """Parse a stage's res.jsonl into DataFrames in linear time.
+
+    Rows are appended to per-column lists and each table is built once at the
+    end. With `workers` > 1 the file is split into byte ranges parsed in a
+    process pool (plain JSONL only); the ranges are concatenated in order.
+    Packed triplet results are unpacked per finding with `packs`. Fused
+    results are parsed in one pass, as their triplet rows are numbered by
+    finding across the whole file.
+    """
+    if workers > 1 and not path.endswith(".gz") and stage != "fused":
+        size = os.path.getsize(path)
+        bounds = [size * i // workers for i in range(workers + 1)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(ingest_range, repeat(path), repeat(stage), bounds[:-1], bounds[1:], repeat(packs)))
+    elif path.endswith(".gz"):
+        parts = [new_tables(stage)]
+        for result in (unpacked for packed in claude.read_results(path) for unpacked in unpack(packed, packs)):
+            if result["result"]["type"] == "succeeded":
+                PARSERS[stage](result, parts[0])
+        if stage in FINISHERS:
+            FINISHERS[stage](parts[0])
+    else:
+        parts = [ingest_range(path, stage, packs=packs)]
+
+    frames = {}
+    for name, columns in TABLES[stage].items():
+        frames[name] = pd.DataFrame({
+            column: [value for part in parts for value in part[name][column]]
+            for column in columns
+        })
+    status = sum((part["status"] for part in parts), Counter())
+    print(f"Parse status: {dict(status)}")
+    if stage == "fused":
+        print(f"Triplet parse status: {dict(sum((part['triplet_status'] for part in parts), Counter()))}")
+    if stage in ["triplets", "fused"]:
+        print(f"Skipped {sum(part['skipped'] for part in parts)} non-interaction findings")
+        frames["keys"] = frames["keys"].drop_duplicates(ignore_index=True)
+        # Dictionary-encoded: Parquet stores each category once, grouping works on integer codes
+        frames["triplets"]["relation"] = pd.Categorical(frames["triplets"]["relation"], categories=list(Relationship))
+        frames["triplets"]["net_outcome"] = pd.Categorical(frames["triplets"]["net_outcome"], categories=list(NetOutcome))
+
+    return frames
+
+def write(df, path):
+    """Write a table as CSV, or Parquet when the path ends in .parquet"""
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+def generate_results(path, lines, stage="findings"):
+    """Write a synthetic res.jsonl with `lines` succeeded results"""
+    if stage == "findings":
+        text = json.dumps({"keywords": ["Education"], "summaries": ["AI tutors increase student learning", "AI feedback reduces errors"], "note": {"type": "", "description": ""}})
+    else:
+        text = json.dumps({"cause": {"type": "ai", "subtype": "llm", "feature": "tutoring"}, "relationship": "INCREASES", "effect": {"type": "human", "subtype": "student", "feature": "learning"}, "net_outcome": "positive"})
+    with open(path, "w") as f:
+        for i in range(lines):
+            custom_id = f"paper-{i}" if stage == "findings" else f"{i}-paper-{i}"
+            f.write(json.dumps({"custom_id": custom_id, "result": {"type": "succeeded", "message": {"content": [{"type": "text", "text": text}]}}}) + "\n")
+
+def ingest_loc(path):
+    """Previous findings parsing: one df.loc append per result and per finding"""
+    df = pd.DataFrame(columns=TABLES["findings"]["res"])
+    df_findings = pd.DataFrame(columns=TABLES["findings"]["findings"])
+    for result in claude.read_results(path):
+        custom_id = result["custom_id"]
+        content = json.loads(result["result"]["message"]["content"][0]["text"])
+        summary_data = AbstractSummary(**content)
+        df.loc[len(df)] = [custom_id, str(summary_data.keywords), str(summary_data.summaries), str(summary_data.note)]
+        for finding in summary_data.summaries:
+            df_findings.loc[len(df_findings)] = [custom_id, finding]
+    return df, df_findings
+
+def benchmark_ingest(sizes=(10000, 100000, 1000000), workers=4, loc_limit=2000):
+    """Time df.loc appends vs columnar ingest (serial and process pool) on synthetic findings results"""
+    import tempfile
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in sizes:
+            path = os.path.join(tmp, f"res-{lines}.jsonl")
+            generate_results(path, lines)
+            timings[lines] = {}
+            print(f"{lines} lines")
+
+            runs = [("columnar", lambda: ingest(path, "findings")), (f"columnar x{workers}", lambda: ingest(path, "findings", workers=workers))]
+            if lines <= loc_limit:
+                runs.insert(0, ("df.loc", lambda: ingest_loc(path)))
+            for name, run in runs:
+                start = time.perf_counter()
+                run()
+                timings[lines][name] = time.perf_counter() - start
+                print(f"- {name}: {timings[lines][name]:.2f}s")
+    return timings
+
+def benchmark_validation(rows=100000):
+    """Time per-row Triplet(cause=Subject(**...)) construction vs one validate_bulk pass.
+
+    Every 100th triplet needs its categories normalized, the rest are canonical.
+    """
+    objs = [{"cause": {"type": "ai", "subtype": "llm", "feature": f"tutoring{i}"}, "relationship": "INCREASES", "effect": {"type": "human", "subtype": "student", "feature": "learning"}, "net_outcome": "positive"} for i in range(rows)]
+    for content in objs[::100]:
+        content.update(relationship=" increases", net_outcome="Positive")
+
+    start = time.perf_counter()
+    for content in objs:
+        Triplet(cause=Subject(**content["cause"]), relationship=content["relationship"], effect=Subject(**content["effect"]), net_outcome=content.get("net_outcome", "undetermined"))
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for content in validate_bulk(objs, MODELS["triplets"]):
+        pass
+    bulk = time.perf_counter() - start
+
+    print(f"{rows} triplets")
+    print(f"- per row: {per_row:.2f}s")
+    print(f"- bulk: {bulk:.2f}s")
+    return {"per_row": per_row, "bulk": bulk}
+
+def benchmark_extraction(path, stage="findings"):
+    """Compare the previous brace-slicing parse with extract_model on a real res.jsonl"""
+    model = AbstractSummary if stage == "findings" else Triplet | SkipResult
+    texts = [result["result"]["message"]["content"][0]["text"] for result in claude.read_results(path) if result["result"]["type"] == "succeeded"]
+
+    def previous(text):
+        try:
+            content = json.loads(text[text.index("{"):text.rfind("}") + 1])
+        except (ValueError, json.JSONDecodeError):
+            try:
+                content = json.loads("{" + text)
+            except json.JSONDecodeError:
+                return None
+        try:
+            if stage == "findings":
+                return AbstractSummary(**content)
+            return SkipResult(**content) if content.get("skip") else Triplet(cause=Subject(**content["cause"]), relationship=content["relationship"], effect=Subject(**content["effect"]), net_outcome=content.get("net_outcome", "undetermined"))
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    parsed_previous = sum(previous(text) is not None for text in texts)
+    elapsed_previous = time.perf_counter() - start
+
+    start = time.perf_counter()
+    status = Counter(claude.extract_model(text, model)[1] for text in texts)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(texts)} responses")
+    print(f"- previous: {elapsed_previous:.2f}s, {parsed_previous} parsed")
+    print(f"- extract_model: {elapsed:.2f}s, {status['ok'] + status['repaired'] + status['prefilled']} parsed")
+    print(f"- status: {dict(status)}")
+    return {"previous": elapsed_previous, "extract_model": elapsed, "status": dict(status)}
+
+def answers(path, packs=None):
+    """custom_id -> validated triplet answer for every parseable result in `path`"""
+    parsed = {}
+    for result in (unpacked for packed in claude.read_results(path) for unpacked in unpack(packed, packs)):
+        if result["result"]["type"] != "succeeded":
+            continue
+        content, status = claude.extract_model(result["result"]["message"]["content"][0]["text"], MODELS["triplets"])
+        if content is not None and not (isinstance(content, SkipResult) and not content.skip):
+            parsed[result["custom_id"]] = content
+    return parsed
+
+def prompt_tokens(path):
+    """Total input tokens, cached or not, billed for the succeeded results in `path`"""
+    total = 0
+    for result in claude.read_results(path):
+        if result["result"]["type"] == "succeeded":
+            usage = result["result"]["message"]["usage"]
+            total += usage["input_tokens"] + usage.get("cache_creation_input_tokens", 0) + usage.get("cache_read_input_tokens", 0)
+    return total
+
+def compare_packing(baseline_path, packed_path, packs):
+    """Compare packed triplet answers with a one-finding-per-request run of the same findings.
+
+    Agreement is measured on the findings both runs answered: the skip
+    decision, the relationship, cause/effect types and the extracted keys.
+    """
+    baseline, packed = answers(baseline_path), answers(packed_path, packs)
+    findings = [custom_id for members in packs.values() for custom_id in members]
+    both = [custom_id for custom_id in findings if custom_id in baseline and custom_id in packed]
+
+    def keys(content):
+        if isinstance(content, SkipResult):
+            return None
+        return triplets.parse_key_list(content.cause) + triplets.parse_key_list(content.effect)
+
+    def agree(get):
+        pairs = [(get(baseline[c]), get(packed[c])) for c in both if not isinstance(baseline[c], SkipResult) and not isinstance(packed[c], SkipResult)]
+        return sum(a == b for a, b in pairs) / len(pairs) if pairs else 0.0
+
+    report = {
+        "findings": len(findings),
+        "answered_baseline": sum(c in baseline for c in findings) / len(findings),
+        "answered_packed": sum(c in packed for c in findings) / len(findings),
+        "skip": sum(isinstance(baseline[c], SkipResult) == isinstance(packed[c], SkipResult) for c in both) / len(both) if both else 0.0,
+        "relationship": agree(lambda content: content.relationship),
+        "types": agree(lambda content: (content.cause.type, content.effect.type)),
+        "keys": agree(keys),
+        "input_tokens_baseline": prompt_tokens(baseline_path),
+        "input_tokens_packed": prompt_tokens(packed_path),
+    }
+    print(f"{len(findings)} findings in {len(packs)} packs")
+    print(f"- answered: {report['answered_baseline']:.1%} one per request, {report['answered_packed']:.1%} packed")
+    print(f"- agreement on skip: {report['skip']:.1%}, relationship: {report['relationship']:.1%}, types: {report['types']:.1%}, keys: {report['keys']:.1%}")
+    print(f"- input tokens: {report['input_tokens_baseline']} one per request, {report['input_tokens_packed']} packed")
+    return report
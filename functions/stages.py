@@ -0,0 +1,170 @@
+import functions.claude as claude
+import functions.planner as planner
+import functions.results as results
+from functions.store import AbstractStore
+import pandas as pd
+import os
+
+class Stage:
+    """Batch flow shared by the extraction scripts, over one stage's data/<name>/ files.
+
+    Scripts build their requests and write their outputs; submitting,
+    fetching, retrying and merging results is the same for every stage.
+    """
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.dir = os.path.join("data", name)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, file):
+        return os.path.join(self.dir, file)
+
+    def cache(self, load_ids=True):
+        return claude.ResultCache(self.path("cache.jsonl"), load_ids=load_ids)
+
+    def history(self, cached=True):
+        """Results file the output cap and projection are planned from.
+
+        Every succeeded answer in res.jsonl is also in the cache, so reading
+        both would count it twice; without `cached` only res.jsonl is read.
+        """
+        return [self.path("cache.jsonl")] if cached else [self.path("res.jsonl")]
+
+    def submit(self, requests, submitted, cache, history=(), items=None, packs=None):
+        """Dispatch a new run's requests, replacing the previous run's results.
+
+        `requests` were built against `cache`, which skips those with cached
+        results; `submitted` are their params, projected from `history`.
+        """
+        cache.save_ids()
+        print(f"Cached: {len(cache.ids) - len(requests)}, to submit: {len(requests)}")
+
+        if requests:
+            # Projected from the previous run's results, before they are removed
+            planner.projection(self.name, submitted, history, model=self.backend.params(submitted[0])["model"], items=items, packs=packs)
+
+        # A new run replaces the previous run's results
+        if os.path.exists(self.path("res.jsonl")):
+            os.remove(self.path("res.jsonl"))
+
+        if not requests:
+            # Nothing to submit; get_results() merges the cached results alone
+            if os.path.exists(self.path("manifest.json")):
+                os.remove(self.path("manifest.json"))
+            return None
+
+        # Submit batches recorded in the manifest, or run few requests in real time
+        return self.backend.dispatch(requests, self.path("manifest.json"), self.path("res.jsonl"), cache=cache)
+
+    def get_results(self, process_results, batch_ids=None, downloaded=False):
+        """Download completed batches into res.jsonl, merge cached results and process them.
+
+        With `downloaded` the batches are already in res.jsonl and only the
+        merge and `process_results` run.
+        """
+        if batch_ids is None:
+            # Read batch IDs from the manifest
+            batch_ids = claude.load_manifest(self.path("manifest.json")) if os.path.exists(self.path("manifest.json")) else []
+
+        if batch_ids and not downloaded:
+            # Check batch status
+            batch_status = self.backend.get_batches_status(batch_ids)
+            pending = [b.id for b in batch_status if b.processing_status != "ended"]
+            print(f"Batches ended: {len(batch_ids) - len(pending)}/{len(batch_ids)}")
+
+            if pending:
+                print(f"Batches not completed yet: {pending}")
+                return batch_status
+
+        cache = self.cache()
+        res_path = self.path("res.jsonl")
+
+        # Get results, resuming after any already in res.jsonl
+        for batch_id in ([] if downloaded else batch_ids):
+            self.backend.get_batch_results(batch_id, res_path, cache=cache)
+
+        # Token usage of the downloaded batches, before cached results are added
+        claude.usage_report({self.name: res_path})
+
+        # Add results for requests that were served from the cache
+        claude.merge_cached_results(cache, res_path)
+
+        return process_results()
+
+    def retry(self, build_requests, packs=None):
+        """Resubmit the failed results; `build_requests(failed)` rebuilds the requests of a set of custom_ids"""
+        failed = set(results.failed_ids(self.path("res.jsonl"), self.name, packs=packs))
+        print(f"Failed results to retry: {len(failed)}")
+        if not failed:
+            return None
+
+        requests = build_requests(failed)
+        if os.path.exists(self.path("res_retry.jsonl")):
+            os.remove(self.path("res_retry.jsonl"))
+        return self.backend.dispatch(requests, self.path("retry_manifest.json"), self.path("res_retry.jsonl"))
+
+    def get_retry_results(self, process_results, batch_ids=None, downloaded=False):
+        """Merge completed retry batches into res.jsonl and rewrite the stage outputs;
+        `downloaded` when they are already in res_retry.jsonl"""
+        if batch_ids is None:
+            # No manifest when the retry ran in real time
+            batch_ids = claude.load_manifest(self.path("retry_manifest.json")) if os.path.exists(self.path("retry_manifest.json")) else []
+
+        if not downloaded:
+            batch_status = self.backend.get_batches_status(batch_ids)
+            pending = [b.id for b in batch_status if b.processing_status != "ended"]
+            if pending:
+                print(f"Retry batches not completed yet: {pending}")
+                return batch_status
+
+        for batch_id in ([] if downloaded else batch_ids):
+            self.backend.get_batch_results(batch_id, self.path("res_retry.jsonl"))
+
+        claude.replace_results(self.path("res.jsonl"), self.path("res_retry.jsonl"), cache=self.cache())
+        return process_results()
+
+class AbstractStage(Stage):
+    """Stage with one request per abstract, custom_id paper-<row>; `ref_path` maps them to paperIds.
+
+    The graph stage reads the map from data/findings/ref.csv, so stages
+    standing in for the findings stage write it there.
+    """
+    def __init__(self, name, backend, request_params, ref_path=None):
+        super().__init__(name, backend)
+        self.request_params = request_params
+        self.ref_path = ref_path or self.path("ref.csv")
+
+    def submit_abstracts(self):
+        """Submit a request per abstract in the store, with the output cap learned from previous runs"""
+        df = AbstractStore().read(columns=["paperId", "title", "abstract"])
+        history = self.history()
+        max_tokens = planner.plan_max_tokens(history)
+
+        # Create batch requests, skipping those with cached results
+        cache = self.cache(load_ids=False)
+        requests = []
+        submitted = []
+        for i, row in df.iterrows():
+            params = self.request_params(row, max_tokens)
+            request = self.backend.create_request(f"paper-{i}", params, cache=cache, cache_system=True)
+            if request:
+                requests.append(request)
+                submitted.append(params)
+
+        # Save reference mapping
+        os.makedirs(os.path.dirname(self.ref_path), exist_ok=True)
+        pd.DataFrame({"id": df["paperId"], "ref_id": [f"paper-{i}" for i in df.index]}).to_csv(self.ref_path, index=False)
+
+        return self.submit(requests, submitted, cache, history)
+
+    def retry_abstracts(self, max_tokens=16384, repair=True):
+        """Resubmit the failed results, rebuilt from the abstracts they were made from"""
+        def retry_requests(failed):
+            ref = pd.read_csv(self.ref_path)
+            abstracts = AbstractStore().read(columns=["paperId", "title", "abstract"]).set_index("paperId")
+            return [
+                self.backend.create_request(custom_id, claude.retry_params(self.request_params(abstracts.loc[paper_id]), max_tokens, repair), cache_system=True)
+                for paper_id, custom_id in zip(ref["id"], ref["ref_id"]) if custom_id in failed
+            ]
+        return self.retry(retry_requests)
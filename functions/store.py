@@ -0,0 +1,228 @@
+import functions.triplets as triplets
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
+import glob
+import json
+import os
+
+class AbstractStore:
+    """Parquet abstract store keyed by paperId.
+
+    Each upsert appends one part file holding only the new batch, so ingest
+    cost follows the batch size. Reads concatenate the parts with later parts
+    winning on paperId; compact() folds them back into a single part.
+    """
+    columns = ["paperId", "title", "abstract", "publicationDate", "source"]
+
+    def __init__(self, path="data/abstract/store"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = None
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def load_index(self):
+        """paperId -> title key and title key -> paperId for everything stored"""
+        if self.index is None:
+            keys = self.read(columns=["paperId", "title_key"])
+            self.index = (
+                dict(zip(keys["paperId"], keys["title_key"])),
+                dict(zip(keys["title_key"], keys["paperId"]))
+            )
+        return self.index
+
+    def upsert(self, papers, source):
+        """Add or replace papers from one source, skipping incomplete rows and
+        papers already stored under another paperId (matched by title)"""
+        df = pd.DataFrame.from_records([paper for paper in papers if paper])
+        for c in self.columns[:-1]:
+            if c not in df.columns:
+                df[c] = None
+        missing = df[self.columns[:-1]].isna().any(axis=1) | (df[self.columns[:-1]] == "").any(axis=1)
+        if missing.any():
+            print(f"Skipped {missing.sum()} {source} papers with missing fields")
+        df = df.loc[~missing, self.columns[:-1]].copy()
+        df["title"] = df["title"].str.split().str.join(" ")
+        df["source"] = source
+        df["title_key"] = df["title"].str.casefold()
+        df = df.drop_duplicates("paperId")
+
+        by_id, by_title = self.load_index()
+        owner = df["title_key"].map(by_title)
+        duplicate = owner.notna() & (owner != df["paperId"])
+        if duplicate.any():
+            print(f"Skipped {duplicate.sum()} {source} papers already stored from another source")
+        df = df.loc[~duplicate].drop_duplicates("title_key").reset_index(drop=True)
+        if df.empty:
+            return 0
+
+        part = os.path.join(self.path, f"part-{len(self.parts()):05d}.parquet")
+        df.to_parquet(part, index=False)
+        for paper_id, key in zip(df["paperId"], df["title_key"]):
+            by_title.pop(by_id.get(paper_id), None)
+            by_id[paper_id] = key
+            by_title[key] = paper_id
+        return len(df)
+
+    def read(self, columns=None):
+        """Read the deduplicated store, loading only `columns` from disk"""
+        columns = columns or self.columns
+        load = columns if "paperId" in columns else ["paperId", *columns]
+        parts = self.parts()
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat([pd.read_parquet(part, columns=load) for part in parts], ignore_index=True)
+        df = df.drop_duplicates("paperId", keep="last").reset_index(drop=True)
+        return df[columns]
+
+    def compact(self):
+        df = self.read(columns=[*self.columns, "title_key"])
+        tmp = os.path.join(self.path, "compact.tmp")
+        df.to_parquet(tmp, index=False)
+        for part in self.parts():
+            os.remove(part)
+        os.replace(tmp, os.path.join(self.path, "part-00000.parquet"))
+        return len(df)
+
+    def to_csv(self, path="data/abstract/abstract.csv"):
+        self.read(columns=self.columns[:-1]).to_csv(path, index=False)
+
+class TripletStore:
+    """Parquet triplet table with structured subjects and precomputed keys.
+
+    cause and effect are struct<type, subtype, feature> columns; relation,
+    net_outcome and the cause/effect *_full and *_short keys are dictionary
+    encoded. Reads load only the requested columns, so consumers of the keys
+    never touch the subjects or parse JSON.
+    """
+    subject = pa.struct([("type", pa.dictionary(pa.int8(), pa.string())), ("subtype", pa.string()), ("feature", pa.string())])
+    columns = ["paper-id", "cause", "relation", "effect", "net_outcome", "cause_full", "cause_short", "effect_full", "effect_short"]
+
+    def __init__(self, path="data/triplets/triplets.parquet"):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def write(self, df):
+        """Replace the store with an ingested triplets table (subjects as parse_subject JSON)"""
+        arrays = {"paper-id": pa.array(df["paper-id"], pa.string())}
+        keys = {}
+        for t in ["cause", "effect"]:
+            codes, parsed, subject_keys = triplets.distinct_subjects(df[t])
+            distinct = pa.StructArray.from_arrays([
+                pa.array([d["type"] for d in parsed], pa.string()).dictionary_encode().cast(self.subject.field("type").type),
+                pa.array([d["subtype"] for d in parsed], pa.string()),
+                pa.array([d["feature"] for d in parsed], pa.string()),
+            ], fields=list(self.subject))
+            arrays[t] = distinct.take(pa.array(codes, pa.int32()))
+            for kind in ["full", "short"]:
+                # Different subjects can share a key: re-factorize the keys of the distinct subjects
+                key_codes, key_values = pd.factorize(pd.Series([getattr(k, kind) for k in subject_keys], dtype=object))
+                keys[f"{t}_{kind}"] = pa.DictionaryArray.from_arrays(pa.array(key_codes[codes], pa.int32()), pa.array(key_values, pa.string()))
+        for c in ["relation", "net_outcome"]:
+            arrays[c] = pa.array(pd.Categorical(df[c]))
+        table = pa.table({c: (arrays | keys)[c] for c in self.columns})
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, self.path)
+        return len(table)
+
+    def read(self, columns=None):
+        """Read the triplets, loading only `columns` from disk; dictionary columns come back categorical"""
+        return pq.read_table(self.path, columns=columns or self.columns).to_pandas()
+
+class EmbeddingStore:
+    """Append-only float32 embedding matrix per model, with a key -> row index.
+
+    Vectors live in a raw float32 file (vectors.f32) that is appended to and
+    memory-mapped for reads; keys.txt holds the key of each row in order.
+    Stores are namespaced by model, so keys embedded by one model are never
+    served for another. Vectors are written before their keys, and rows
+    without a key (an interrupted append) are truncated on open.
+    """
+    def __init__(self, model, path="data/embeddings/store"):
+        self.model = model
+        self.path = os.path.join(path, model.replace("/", "__"))
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.keys_path = os.path.join(self.path, "keys.txt")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        self.keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                self.keys = f.read().splitlines()
+        if self.dim is not None:
+            # meta.json is written before the first vectors, so vectors.f32 may not exist yet
+            size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            rows = size // (4 * self.dim)
+            if rows < len(self.keys):
+                # Keys without vectors cannot come from append(); keep the rows that have both
+                self.keys = self.keys[:rows]
+                with open(self.keys_path, "w") as f:
+                    f.write("".join(k + "\n" for k in self.keys))
+            if rows * 4 * self.dim != size:
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(len(self.keys) * 4 * self.dim)
+        self.index = {k: i for i, k in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def missing(self, keys):
+        """Keys not stored yet, in order and without duplicates"""
+        return list(dict.fromkeys(k for k in keys if k not in self.index))
+
+    def append(self, keys, vectors):
+        """Add vectors (one row per key); keys already stored are skipped"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(keys):
+            raise ValueError(f"Expected {len(keys)} vectors, got shape {vectors.shape}")
+        added = set()
+        new = []
+        for i, k in enumerate(keys):
+            if k not in self.index and k not in added:
+                added.add(k)
+                new.append(i)
+        if not new:
+            return 0
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.meta_path, "w") as f:
+                json.dump({"model": self.model, "dim": self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d vectors for {self.model}, got {vectors.shape[1]}-d")
+
+        with open(self.vectors_path, "ab") as f:
+            f.write(vectors[new].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.keys_path, "a") as f:
+            f.write("".join(keys[i] + "\n" for i in new))
+        for i in new:
+            self.index[keys[i]] = len(self.keys)
+            self.keys.append(keys[i])
+        return len(new)
+
+    def matrix(self):
+        """Read-only memory map of all stored vectors, (rows, dim) float32"""
+        if not self.keys:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.keys), self.dim))
+
+    def get(self, keys):
+        """Vectors of `keys` in order, (len(keys), dim) float32; raises KeyError for keys not stored"""
+        return self.matrix()[[self.index[k] for k in keys]]
@@ -0,0 +1,122 @@
+import functions.claude as claude
+import functions.backend as llm_backend
+import importlib.util
+import json
+import os
+import sys
+import time
+import dotenv
+
+dotenv.load_dotenv()
+
+backend = llm_backend.get_backend()
+
+state_path = "data/pipeline.json"
+
+# Batch stages in order; each one's results feed the next stage's requests.
+# PIPELINE_FUSED=1 extracts findings and triplets in one batch round-trip instead
+stages = ["fused"] if os.getenv("PIPELINE_FUSED") == "1" else ["findings", "triplets"]
+scripts = {
+    "findings": "4. findings-claude.py",
+    "fused": "4. fused-claude.py",
+    "triplets": "5. triplet-claude.py",
+    "embedding": "6. embedding.py",
+}
+
+modules = {}
+
+def load_script(stage):
+    """Import a numbered stage script as a module"""
+    if stage not in modules:
+        spec = importlib.util.spec_from_file_location(stage, scripts[stage])
+        modules[stage] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modules[stage])
+    return modules[stage]
+
+def load_state(restart=False):
+    if not restart and os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            return json.load(f)
+    return {"stage": stages[0], "submitted": False, "downloaded": []}
+
+def save_state(state):
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=2)
+
+def next_stage(state):
+    i = stages.index(state["stage"]) + 1
+    return {"stage": stages[i] if i < len(stages) else "embedding", "submitted": False, "downloaded": []}
+
+def run(restart=False, poll=60, max_poll=1800):
+    """Submit, poll, download and chain stages until embeddings are written.
+
+    Each stage's errored or unparseable results are resubmitted once before
+    the next stage starts. Progress is kept in data/pipeline.json, so a
+    restarted orchestrator picks up the outstanding batches instead of
+    resubmitting; `restart` begins again from the findings stage. Batches are
+    polled together and each one is downloaded as soon as it ends, once; the
+    stage then only merges cached results and processes res.jsonl. Polling
+    backs off while nothing changes.
+    """
+    state = load_state(restart)
+    delay = poll
+
+    while state["stage"] != "done":
+        stage = state["stage"]
+
+        if stage == "embedding":
+            print("Stage embedding: embedding triplet keys")
+            load_script("embedding").main()
+            state = {"stage": "done", "submitted": False, "downloaded": []}
+            save_state(state)
+            break
+
+        script = load_script(stage)
+        retrying = state.get("retry") == "submitted"
+        manifest_path = f"data/{stage}/retry_manifest.json" if retrying else f"data/{stage}/manifest.json"
+
+        if not state["submitted"]:
+            print(f"Stage {stage}: submitting")
+            script.main()
+            state["submitted"] = True
+            save_state(state)
+
+        batch_ids = claude.load_manifest(manifest_path) if os.path.exists(manifest_path) else []
+        statuses = backend.get_batches_status(batch_ids)
+
+        ended = [b.id for b in statuses if b.processing_status == "ended"]
+        fresh = [batch_id for batch_id in ended if batch_id not in state["downloaded"]]
+        if fresh:
+            cache = None if retrying else claude.ResultCache(f"data/{stage}/cache.jsonl")
+            for batch_id in fresh:
+                backend.get_batch_results(batch_id, f"data/{stage}/res_retry.jsonl" if retrying else f"data/{stage}/res.jsonl", cache=cache)
+                state["downloaded"].append(batch_id)
+            save_state(state)
+
+        if len(ended) == len(batch_ids):
+            print(f"Stage {stage}: all {len(batch_ids)} {'retry ' if retrying else ''}batches ended, processing results")
+            if retrying:
+                script.get_retry_results(batch_ids=batch_ids, downloaded=True)
+                state = next_stage(state)
+            else:
+                script.get_results(batch_ids=batch_ids, downloaded=True)
+                # Errored and unparseable results get one follow-up batch
+                if script.retry():
+                    state.update(retry="submitted", downloaded=[])
+                else:
+                    state = next_stage(state)
+            save_state(state)
+            delay = poll
+            continue
+
+        processing = sum(b.processing for b in statuses)
+        print(f"Stage {stage}: {len(ended)}/{len(batch_ids)} batches ended, {processing} requests processing; next poll in {delay}s")
+        time.sleep(delay)
+        delay = poll if fresh else min(delay * 2, max_poll)
+
+    print("Pipeline complete")
+    return state
+
+if __name__ == "__main__":
+    # python orchestrate.py [restart]
+    run(restart="restart" in sys.argv[1:])